@@ -1,4 +1,8 @@
 from .control import *
+from .cache import *
+from .addressbook import *
+from .usersocket import *
+from .metrics import *
 
 __doc__ = """
 Dead simple I2P SAM library. Download now and enjoy Garlic Routing today!
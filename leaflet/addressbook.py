@@ -0,0 +1,149 @@
+import base64
+import binascii
+import mmap
+import struct
+import threading
+from time import time
+
+from .samtools import Dest
+
+
+magic = b'LAB\x01'
+record_header = struct.Struct('!32sIB')
+blob_header = struct.Struct('!H')
+
+class AddressBook(object):
+    """An append-only file of resolved Destinations.
+
+    Each record holds the SHA-256 hash of a Destination, the time it was
+    stored, the name it was looked up with, and its raw ``keys_cert``. A
+    record with an empty blob is an alias for an earlier record with the
+    same hash. A later record for a name overrides the earlier ones. The
+    file is indexed the first time it is used, and blobs are read on demand.
+    """
+
+    __slots__ = ('path', 'file', 'names', 'hashes', 'end', 'lock')
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.names = None
+        self.hashes = None
+        self.end = 0
+        self.lock = threading.Lock()
+
+    def _load(self):
+        self.names = {}
+        self.hashes = {}
+        f = open(self.path, 'a+b')
+        size = f.seek(0, 2)
+        if size == 0:
+            f.write(magic)
+            f.flush()
+            self.file, self.end = f, len(magic)
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if m[:len(magic)] != magic:
+                f.close()
+                raise ValueError('%r is not an address book' % self.path)
+            pos = len(magic)
+            while pos + record_header.size + blob_header.size <= size:
+                digest, stored_at, name_len = record_header.unpack_from(m, pos)
+                name_end = pos + record_header.size + name_len
+                if name_end + blob_header.size > size:
+                    break
+                blob_len = blob_header.unpack_from(m, name_end)[0]
+                blob_start = name_end + blob_header.size
+                if blob_start + blob_len > size:
+                    break
+                self._index(digest, stored_at, m[name_end-name_len:name_end].decode('ascii'), blob_start, blob_len)
+                pos = blob_start + blob_len
+
+        if pos < size:
+            # drop a record torn by a crash
+            f.truncate(pos)
+        self.file, self.end = f, pos
+
+    def _index(self, digest, stored_at, name, blob_start, blob_len):
+        if blob_len:
+            self.hashes[digest] = (blob_start, blob_len)
+        if name and digest in self.hashes:
+            self.names[name] = self.hashes[digest] + (stored_at,)
+
+    def entry(self, name):
+        """return (Dest, time stored) of a normalized name, or None.
+
+        The time is None for a ``.b32.i2p`` address, which cannot go stale.
+        """
+        with self.lock:
+            if self.names is None:
+                self._load()
+            location = self.names.get(name)
+            if location is None and name.endswith('.b32.i2p'):
+                location = self.hashes.get(b32_digest(name))
+                if location is not None:
+                    location += (None,)
+            if location is None:
+                return None
+            self.file.seek(location[0])
+            keys_cert = self.file.read(location[1])
+        return (Dest(keys_cert, encoding='raw'), location[2])
+
+    def get(self, name):
+        """return the stored Dest of a normalized name, or None"""
+        entry = self.entry(name)
+        return None if entry is None else entry[0]
+
+    def add(self, name, dest):
+        """store a Dest under a normalized name, replacing any earlier one"""
+        keys_cert = dest.keys_cert
+        digest = dest.digest
+        if name == dest.base32 + '.b32.i2p' or len(name) > 255:
+            # the hash already indexes it
+            name = ''
+        with self.lock:
+            if self.names is None:
+                self._load()
+            if not name and digest in self.hashes:
+                return
+            blob = b'' if digest in self.hashes else keys_cert
+            name_bytes = name.encode('ascii')
+            stored_at = int(time())
+            record = b''.join((
+                record_header.pack(digest, stored_at, len(name_bytes)), name_bytes,
+                blob_header.pack(len(blob)), blob))
+            self.file.write(record)
+            self.file.flush()
+            self._index(digest, stored_at, name, self.end + len(record) - len(blob), len(blob))
+            self.end += len(record)
+
+    def __len__(self):
+        with self.lock:
+            if self.names is None:
+                self._load()
+            return len(self.hashes)
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+                self.names = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def b32_digest(domain):
+    b32 = domain[:-len('.b32.i2p')].upper()
+    try:
+        return base64.b32decode(b32 + '=' * (-len(b32) % 8))
+    except binascii.Error:
+        return None
+
+
+__all__ = ('AddressBook',)
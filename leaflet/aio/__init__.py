@@ -0,0 +1,5 @@
+from .control import *
+
+__doc__ = """
+asyncio flavour of leaflet. Streams are asyncio StreamReader/StreamWriter pairs.
+"""
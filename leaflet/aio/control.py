@@ -0,0 +1,190 @@
+import asyncio
+
+from .. import samtools
+from ..cache import NSCache
+from ..control import (default_sam_api, default_dgram_api, default_max_version,
+    default_timeout, check_dest_options)
+
+
+async def sam_run(reader, writer, parser):
+    """Drive a command generator over an asyncio SAM connection, returning its result"""
+    request = next(parser)
+    writer.write(samtools.sam_pack(request))
+    await writer.drain()
+    result = None
+    while result is None:
+        line = await reader.readline()
+        if not line.endswith(b'\n'):
+            raise EOFError('SAM connection died. Partial response %r' % line)
+        result = parser.send(line[:-1].decode('ascii'))
+    return result
+
+async def handshake(timeout, sam_api, max_version):
+    """handshake with sam, returning a (reader, writer) pair"""
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(*sam_api), timeout)
+    try:
+        await asyncio.wait_for(sam_run(reader, writer, samtools.hello(max_version)), timeout)
+    except BaseException:
+        writer.close()
+        raise
+    return (reader, writer)
+
+
+class AsyncController(object):
+    __slots__ = ('sam_timeout', 'sam_api', 'dgram_api', 'max_version', 'ns_cache')
+
+    def __init__(self,
+                 sam_timeout=default_timeout,
+                 sam_api=default_sam_api,
+                 dgram_api=default_dgram_api,
+                 max_version=default_max_version,
+                 ns_cache=None):
+        self.sam_timeout = sam_timeout
+        self.sam_api = sam_api
+        self.dgram_api = dgram_api
+        self.max_version = max_version
+        self.ns_cache = NSCache() if ns_cache is None else ns_cache
+
+    @property
+    def handshake_args(self):
+        return (self.sam_timeout, self.sam_api, self.max_version)
+
+    async def check_api(self):
+        reader, writer = await handshake(*self.handshake_args)
+        writer.close()
+
+    async def lookup(self, name):
+        dest = samtools.lookup_cache(name, self.ns_cache)
+        if dest:
+            return dest
+        else:
+            return await self._lookup(name)
+
+    async def _lookup(self, name):
+        reader, writer = await handshake(*self.handshake_args)
+        try:
+            parser = samtools.naming_lookup(name, self.ns_cache)
+            return await asyncio.wait_for(sam_run(reader, writer, parser), self.sam_timeout)
+        finally:
+            writer.close()
+
+    async def create_dest(self, name = None, style='stream', forward = None, i2cp = None, keyfile = None):
+        name, style, forward = check_dest_options(name, style, forward)
+        if style == 'primary':
+            raise NotImplementedError('leaflet.aio has no primary sessions')
+        if style != 'stream' and forward:
+            raise NotImplementedError('leaflet.aio carries datagrams over the SAM connection, without forward')
+        i2cp = dict(i2cp or {})
+        if forward:
+            i2cp['HOST'], i2cp['PORT'] = forward
+
+        private_key = samtools.load_keyfile(keyfile) if keyfile else None
+        if private_key:
+            sig_type = samtools.Dest.read_sig_type(private_key)
+        else:
+            sig_type = samtools.Dest.default_sig_type
+        reader, writer = await handshake(*self.handshake_args)
+        try:
+            parser = samtools.session_setup(style, sig_type, name, i2cp, private_key)
+            reply_key = await asyncio.wait_for(sam_run(reader, writer, parser), self.sam_timeout)
+        except BaseException:
+            writer.close()
+            raise
+
+        dest = AsyncOurDest(self, name, style, forward, reply_key, sig_type, (reader, writer))
+        if keyfile and not private_key:
+            samtools.save_keyfile(keyfile, dest.private_key)
+        return dest
+
+
+class AsyncOurDest(samtools.Dest):
+    __slots__ = ('name', 'sam_stream', 'controller', 'style', 'forward')
+
+    def __init__(self, controller, name, style, forward, keyfile, sig_type, sam_stream):
+        self.controller = controller
+        self.name = name
+        self.style = style
+        self.forward = forward
+        self.sam_stream = sam_stream
+
+        super().__init__(keyfile, sig_type=sig_type, encoding='base64', private=True)
+
+    @property
+    def handshake_args(self):
+        return self.controller.handshake_args
+
+    async def connect(self, other):
+        """connect to a remote destination, returning a (reader, writer) pair"""
+        dest = await self.controller.lookup(other)
+        parser = samtools.stream_connect(self.name, dest)
+        reader, writer = await self._open_stream(parser)
+        return (reader, writer)
+
+    async def accept(self):
+        """wait for an incoming stream, returning a (reader, writer, source Dest) tuple"""
+        parser = samtools.stream_accept(self.name)
+        reader, writer, dest = await self._open_stream(parser)
+        return (reader, writer, dest)
+
+    async def _open_stream(self, parser):
+        reader, writer = await handshake(*self.handshake_args)
+        try:
+            result = await sam_run(reader, writer, parser)
+        except BaseException:
+            writer.close()
+            raise
+        if isinstance(result, samtools.Dest):
+            return (reader, writer, result)
+        else:
+            return (reader, writer)
+
+    def _check_datagrams(self):
+        if self.style not in ('datagram', 'raw'):
+            raise NotImplementedError('Only datagram and raw Destinations carry datagrams')
+
+    async def transmit(self, data, dest):
+        """send a datagram to a name or a Dest over the SAM connection of the session"""
+        self._check_datagrams()
+        dest = await self.controller.lookup(dest)
+        send = samtools.raw_send if self.style == 'raw' else samtools.datagram_send
+        reader, writer = self.sam_stream
+        writer.write(samtools.sam_pack(next(send(data, dest))))
+        await writer.drain()
+        return len(data)
+
+    async def collect(self):
+        """wait for a datagram, returning (data, source Dest), the source being None for raw"""
+        self._check_datagrams()
+        verb = b'RAW RECEIVED' if self.style == 'raw' else b'DATAGRAM RECEIVED'
+        reader, writer = self.sam_stream
+        while True:
+            line = await reader.readline()
+            if not line.endswith(b'\n'):
+                raise EOFError('SAM connection died. Partial response %r' % line)
+            line = line[:-1]
+            if line.startswith(verb):
+                reply = samtools.sam_parse_reply(line)
+                data = await reader.readexactly(int(reply['SIZE']))
+                b64 = reply.get('DESTINATION')
+                return (data, None if b64 is None else samtools.Dest(b64, encoding='base64'))
+            if line.startswith(b'PING'):
+                # not a datagram, answer keepalives and skip the rest
+                writer.write(samtools.sam_pack('PONG' + line[4:].decode('ascii')))
+
+    def close(self):
+        reader, writer = self.sam_stream
+        writer.close()
+
+    async def wait_closed(self):
+        reader, writer = self.sam_stream
+        await writer.wait_closed()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        self.close()
+        await self.wait_closed()
+
+
+__all__ = ('AsyncController', 'AsyncOurDest')
@@ -0,0 +1,5 @@
+__doc__ = """
+Benchmarks that run against an in-process fake SAM bridge.
+
+    python3 -m leaflet.bench    run the whole suite, printing JSON
+"""
@@ -0,0 +1,68 @@
+"""Measure Dest parsing and encoding, and the cost per packet of DatagramSocket.transmit.
+
+    python3 -m leaflet.bench.dest [packets]
+"""
+
+import socket as pysocket
+import sys
+from time import perf_counter
+
+from .. import Controller
+from ..samtools import Dest
+from ..usersocket import DatagramSocket
+from .fakesam import FakeSAM, random_keys_cert
+
+
+def per_call(func, count):
+    start = perf_counter()
+    for i in range(count):
+        func()
+    return (perf_counter() - start) / count * 1e6
+
+
+def dest_rates(count):
+    b64 = Dest(random_keys_cert(), encoding='raw').base64
+    dest = Dest(b64, encoding='base64')
+    return {
+        'parse_base64': per_call(lambda: Dest(b64, encoding='base64'), count),
+        'base64_cold': per_call(lambda: Dest(b64, encoding='base64').base64, count),
+        'base64_memoized': per_call(lambda: dest.base64, count),
+        'base32_cold': per_call(lambda: Dest(b64, encoding='base64').base32, count),
+        'base32_memoized': per_call(lambda: dest.base32, count),
+    }
+
+
+def transmit_rates(sam, count):
+    sink = pysocket.socket(type=pysocket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))
+    sink.setsockopt(pysocket.SOL_SOCKET, pysocket.SO_RCVBUF, 1 << 16)
+    controller = Controller(sam_api=sam.sam_api, dgram_api=sink.getsockname())
+
+    sock = pysocket.socket(type=pysocket.SOCK_DGRAM)
+    dgram = DatagramSocket(sock, controller, 'bench')
+    dest = sam.dest
+    b64 = dest.base64
+    data = b'x' * 64
+
+    results = {
+        # a fresh Dest per packet pays for the base64 encoding every time
+        'transmit_fresh_dest': per_call(lambda: dgram.transmit(data, Dest(b64, encoding='base64')), count),
+        'transmit_same_dest': per_call(lambda: dgram.transmit(data, dest), count),
+        'transmit_same_name': per_call(lambda: dgram.transmit(data, 'bench.i2p'), count),
+    }
+    sock.close()
+    sink.close()
+    controller.close()
+    return results
+
+
+def main(count=20000):
+    with FakeSAM() as sam:
+        results = dest_rates(count)
+        results.update(transmit_rates(sam, count))
+    for (name, usec) in results.items():
+        print('%-22s %8.2f usec' % (name, usec))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,187 @@
+"""A tiny fake SAM bridge, good enough to benchmark leaflet on localhost"""
+
+import os
+import socket as pysocket
+import struct
+import threading
+from time import sleep
+
+from ..samtools import Dest, sam_parse_reply
+
+
+def random_keys_cert(sig_type=Dest.EdDSA_SHA512_Ed25519):
+    # 256 byte public key, 128 byte signing key, then a KEY certificate
+    cert = struct.pack('!BHHH', 5, 4, sig_type, 0)
+    return os.urandom(256 + 128) + cert
+
+def random_private_key(sig_type=Dest.EdDSA_SHA512_Ed25519):
+    sskey_len = Dest.sskey_len_dict[sig_type]
+    return random_keys_cert(sig_type) + os.urandom(256 + sskey_len)
+
+
+class FakeSAM(object):
+    """Answer SAM commands on a local TCP port, one thread per connection.
+
+    Every known name resolves to the same random Destination. Names that
+    start with ``bad`` do not resolve. `latency` seconds are slept before
+    each reply to mimic a slow router.
+
+    Datagrams sent to the UDP port at `dgram_api` are echoed to the
+    forwarding address of their session, as if they came from `dest`.
+    """
+
+    def __init__(self, host='127.0.0.1', latency=0.0, version='3.3'):
+        self.latency = latency
+        self.version = version
+        self.dest = Dest(random_keys_cert(), encoding='raw')
+        self.listener = pysocket.socket()
+        self.listener.setsockopt(pysocket.SOL_SOCKET, pysocket.SO_REUSEADDR, 1)
+        self.listener.bind((host, 0))
+        self.listener.listen(128)
+        self.sam_api = self.listener.getsockname()
+        self.udp = pysocket.socket(type=pysocket.SOCK_DGRAM)
+        self.udp.bind((host, 0))
+        self.dgram_api = self.udp.getsockname()
+        self.connections = 0
+        self.forwards = []
+        # session ID -> (style, datagram forwarding address or None)
+        self.sessions = {}
+        self.closed = False
+
+    def start(self):
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        threading.Thread(target=self._udp_loop, daemon=True).start()
+        return self
+
+    def close(self):
+        self.closed = True
+        self.listener.close()
+        self.udp.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _accept_loop(self):
+        while not self.closed:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        # a router flushes every reply, Nagle would hold back pipelined ones
+        conn.setsockopt(pysocket.IPPROTO_TCP, pysocket.TCP_NODELAY, 1)
+        with conn:
+            rfile = conn.makefile('rb')
+            try:
+                for line in rfile:
+                    line = line.decode('ascii').strip()
+                    if line.startswith(('DATAGRAM SEND', 'RAW SEND')):
+                        self._echo_datagram(rfile, conn, line.split(' ', 1)[0], sam_parse_reply(line))
+                        continue
+                    reply = self.reply(line)
+                    if reply is None:
+                        continue
+                    if self.latency:
+                        sleep(self.latency)
+                    conn.sendall(reply)
+                    if line.startswith(('STREAM CONNECT', 'STREAM ACCEPT')) and b'RESULT=OK' in reply:
+                        self._echo(rfile, conn)
+                        return
+            except OSError:
+                pass
+
+    def _udp_loop(self):
+        # b'3.0 nickname destination [options]\n' + payload
+        header_template = self.dest.base64.encode('ascii') + b' FROM_PORT=0 TO_PORT=0\n'
+        while not self.closed:
+            try:
+                packet, address = self.udp.recvfrom(64 * 1024)
+            except OSError:
+                return
+            lf_index = packet.find(b'\n')
+            words = packet[0:lf_index].split(b' ')
+            if lf_index < 0 or len(words) < 3:
+                continue
+            style, forward = self.sessions.get(words[1].decode('ascii'), (None, None))
+            if forward is None:
+                continue
+            payload = packet[1+lf_index:]
+            if style != 'RAW':
+                payload = header_template + payload
+            try:
+                self.udp.sendto(payload, forward)
+            except OSError:
+                pass
+
+    def dial(self, payload=b''):
+        """open a stream to the last STREAM FORWARD target, like the router would"""
+        sock = pysocket.create_connection(self.forwards[-1])
+        sock.sendall(self.dest.base64.encode('ascii') + b' FROM_PORT=0 TO_PORT=0\n' + payload)
+        return sock
+
+    def _echo_datagram(self, rfile, conn, verb, opts):
+        # send the datagram back, as if it came from self.dest
+        data = rfile.read(int(opts['SIZE']))
+        if verb == 'RAW':
+            header = 'RAW RECEIVED SIZE=%d\n' % len(data)
+        else:
+            header = 'DATAGRAM RECEIVED DESTINATION=%s SIZE=%d\n' % (self.dest.base64, len(data))
+        conn.sendall(header.encode('ascii') + data)
+
+    def _echo(self, rfile, conn):
+        while True:
+            data = rfile.read1(64 * 1024)
+            if not data:
+                return
+            conn.sendall(data)
+
+    def reply(self, line):
+        """return the encoded reply to one command line"""
+        words = line.split(' ')
+        cmd = ' '.join(words[0:2])
+        opts = sam_parse_reply(line)
+
+        if cmd.startswith('HELLO VERSION'):
+            version = min(opts.get('MAX', '3.0'), self.version)
+            return b'HELLO REPLY RESULT=OK VERSION=%s\n' % version.encode('ascii')
+
+        elif cmd == 'NAMING LOOKUP':
+            name = opts['NAME']
+            if name.startswith('bad'):
+                return b'NAMING REPLY RESULT=KEY_NOT_FOUND NAME=%s\n' % name.encode('ascii')
+            return b'NAMING REPLY RESULT=OK NAME=%s VALUE=%s\n' % (
+                name.encode('ascii'), self.dest.base64.encode('ascii'))
+
+        elif cmd == 'SESSION CREATE':
+            private_key = opts.get('DESTINATION', 'TRANSIENT')
+            if private_key == 'TRANSIENT':
+                private_key = Dest.b64encode(random_private_key())
+            forward = None
+            if 'PORT' in opts:
+                forward = (opts.get('HOST', '127.0.0.1'), int(opts['PORT']))
+            self.sessions[opts['ID']] = (opts.get('STYLE'), forward)
+            return b'SESSION STATUS RESULT=OK DESTINATION=%s\n' % private_key.encode('ascii')
+
+        elif cmd in ('SESSION ADD', 'SESSION REMOVE'):
+            if cmd == 'SESSION ADD' and 'PORT' in opts:
+                self.sessions[opts['ID']] = (opts.get('STYLE'), (opts.get('HOST', '127.0.0.1'), int(opts['PORT'])))
+            return b'SESSION STATUS RESULT=OK ID=%s\n' % opts['ID'].encode('ascii')
+
+        elif cmd == 'STREAM CONNECT':
+            return b'STREAM STATUS RESULT=OK\n'
+
+        elif cmd == 'STREAM FORWARD':
+            self.forwards.append((opts.get('HOST', '127.0.0.1'), int(opts['PORT'])))
+            return b'STREAM STATUS RESULT=OK\n'
+
+        elif cmd == 'STREAM ACCEPT':
+            return b'STREAM STATUS RESULT=OK\n' + self.dest.base64.encode('ascii') + b'\n'
+
+        else:
+            return b'%s RESULT=I2P_ERROR MESSAGE="unknown command"\n' % words[0].encode('ascii')
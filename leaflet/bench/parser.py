@@ -0,0 +1,55 @@
+"""Measure how fast SAM reply lines are parsed, on a corpus of typical replies.
+
+    python3 -m leaflet.bench.parser [rounds]
+"""
+
+import sys
+from time import perf_counter
+
+from ..samtools import Dest, sam_parse_reply, split_kv
+from .fakesam import random_keys_cert, random_private_key
+
+
+def split_parse(line):
+    """the old parser: split on spaces, then on the first '='"""
+    parts = line.split(' ')
+    return (parts[0], {k: v for (k, v) in split_kv(parts[2:])})
+
+
+def corpus():
+    """(name, reply line, option read by the caller) triples"""
+    b64 = Dest(random_keys_cert(), encoding='raw').base64
+    private_b64 = Dest.b64encode(random_private_key())
+    return [
+        ('hello', 'HELLO REPLY RESULT=OK VERSION=3.1', 'RESULT'),
+        ('naming', 'NAMING REPLY RESULT=OK NAME=example.i2p VALUE=%s' % b64, 'VALUE'),
+        ('naming_error', 'NAMING REPLY RESULT=KEY_NOT_FOUND NAME=nowhere.i2p', 'RESULT'),
+        ('session', 'SESSION STATUS RESULT=OK DESTINATION=%s' % private_b64, 'DESTINATION'),
+        ('stream', 'STREAM STATUS RESULT=OK', 'RESULT'),
+        ('stream_error', 'STREAM STATUS RESULT=CANT_REACH_PEER MESSAGE="Connection timed out, peer is offline"', 'RESULT'),
+        ('datagram', 'DATAGRAM RECEIVED DESTINATION=%s SIZE=1024 FROM_PORT=0 TO_PORT=0' % b64, 'SIZE'),
+        ('raw', 'RAW RECEIVED SIZE=1024 FROM_PORT=0 TO_PORT=0 PROTOCOL=18', 'SIZE'),
+    ]
+
+
+def per_second(func, rounds):
+    start = perf_counter()
+    for i in range(rounds):
+        func()
+    return rounds / (perf_counter() - start)
+
+
+def main(rounds=100000):
+    print('%-14s %12s %12s %12s' % ('reply', 'split/s', 'str/s', 'bytes/s'))
+    for (name, line, key) in corpus():
+        data = line.encode('ascii')
+        results = (
+            per_second(lambda: split_parse(line)[1][key], rounds),
+            per_second(lambda: sam_parse_reply(line)[key], rounds),
+            per_second(lambda: sam_parse_reply(data)[key], rounds),
+        )
+        print('%-14s %12.0f %12.0f %12.0f' % ((name,) + results))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
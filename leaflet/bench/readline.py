@@ -0,0 +1,78 @@
+"""Compare the buffered SAM reply reader with a byte-at-a-time reader.
+
+    python3 -m leaflet.bench.readline [lookups]
+"""
+
+import sys
+from time import perf_counter
+
+from .. import samtools
+from .fakesam import FakeSAM
+
+
+class CountingSocket(samtools.SAMSocket):
+    """A SAM socket that counts its recv syscalls"""
+
+    __slots__ = ('recv_calls',)
+
+    def __init__(self, *args, **kwargs):
+        self.recv_calls = 0
+        super().__init__(*args, **kwargs)
+
+    def recv(self, *args):
+        self.recv_calls += 1
+        return super().recv(*args)
+
+    def _fill_buffer(self):
+        self.recv_calls += 1
+        return super()._fill_buffer()
+
+
+def bytewise_readline(sock):
+    """the old reader: one recv per byte"""
+    response = b''
+    while True:
+        c = sock.recv(1)
+        if not c:
+            raise EOFError('SAM connection died')
+        elif c == b'\n':
+            return response.decode('ascii')
+        else:
+            response += c
+
+def buffered_readline(sock):
+    return sock.readline()
+
+
+def run(sam_api, readline, lookups):
+    sock = samtools.controller_connect(sam_api, timeout=10.0)
+    sock = CountingSocket(fileno=sock.detach())
+    sock.settimeout(10.0)
+    samtools.sam_send(sock, samtools.greet('3.0'))
+    readline(sock)
+
+    sock.recv_calls = 0
+    start = perf_counter()
+    for i in range(lookups):
+        samtools.sam_send(sock, 'NAMING LOOKUP NAME=peer%d.i2p' % i)
+        reply = samtools.sam_parse_reply(readline(sock))
+        assert reply.ok
+    elapsed = perf_counter() - start
+    sock.close()
+
+    return {
+        'syscalls_per_reply': sock.recv_calls / lookups,
+        'usec_per_reply': elapsed / lookups * 1e6,
+    }
+
+
+def main(lookups=2000):
+    with FakeSAM() as sam:
+        for (name, readline) in (('bytewise', bytewise_readline), ('buffered', buffered_readline)):
+            result = run(sam.sam_api, readline, lookups)
+            print('%-10s %8.1f recv/reply %10.1f usec/reply' % (
+                name, result['syscalls_per_reply'], result['usec_per_reply']))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,160 @@
+"""Run every benchmark against a fake SAM bridge, and print the results as JSON.
+
+    python3 -m leaflet.bench [--latency SECONDS] [--count N] [--output FILE]
+
+Rates are per second, latencies are in seconds. Compare the output of two
+leaflet versions on the same machine, with the same arguments.
+"""
+
+import argparse
+import json
+import platform
+import socket as pysocket
+import sys
+from time import perf_counter
+
+from .. import Controller, NSCache, samtools
+from ..samtools import Dest
+from .fakesam import FakeSAM, random_keys_cert
+
+
+def rate(func, count):
+    start = perf_counter()
+    for i in range(count):
+        func(i)
+    return count / (perf_counter() - start)
+
+def percentiles(samples):
+    samples = sorted(samples)
+    def at(q):
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+    return {
+        'count': len(samples),
+        'mean': sum(samples) / len(samples),
+        'p50': at(0.5),
+        'p99': at(0.99),
+        'max': samples[-1],
+    }
+
+def timed(func):
+    start = perf_counter()
+    func()
+    return perf_counter() - start
+
+
+def bench_handshake(sam, count):
+    def one(i):
+        samtools.handshake(10.0, sam.sam_api, '3.3').close()
+    return {'handshakes_per_sec': rate(one, count)}
+
+def bench_lookup(sam, count):
+    with Controller(sam_api=sam.sam_api, dgram_api=sam.dgram_api, ns_cache=NSCache(max_entries=2*count)) as controller:
+        cold = rate(lambda i: controller.lookup('peer%d.i2p' % i), count)
+        cached = rate(lambda i: controller.lookup('peer%d.i2p' % i), count)
+        # lookup_many takes its misses in one pipelined batch
+        controller.ns_cache = NSCache()
+        names = ['many%d.i2p' % i for i in range(count)]
+        pipelined = count / timed(lambda: controller.lookup_many(names))
+    return {
+        'cold_per_sec': cold,
+        'cached_per_sec': cached,
+        'pipelined_cold_per_sec': pipelined,
+    }
+
+def bench_streams(sam, count):
+    with Controller(sam_api=sam.sam_api, dgram_api=sam.dgram_api) as controller:
+        with controller.create_dest(style='stream') as dest:
+            def connect():
+                sock = dest.connect(sam.dest)
+                sock.parse_headers()
+                sock.close()
+            def accept():
+                sock = dest.register_accept()
+                sock.parse_headers()
+                sock.close()
+            return {
+                'connect_sec': percentiles([timed(connect) for i in range(count)]),
+                'accept_sec': percentiles([timed(accept) for i in range(count)]),
+            }
+
+def bench_datagrams(sam, count, style, size=64, window=64):
+    listener = pysocket.socket(type=pysocket.SOCK_DGRAM)
+    listener.bind(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+    listener.close()
+
+    with Controller(sam_api=sam.sam_api, dgram_api=sam.dgram_api) as controller:
+        with controller.create_dest(style=style, forward=port) as dest:
+            sock = dest.bind()
+            sock.setsockopt(pysocket.SOL_SOCKET, pysocket.SO_RCVBUF, 1 << 20)
+            sock.settimeout(0.5)
+            data = b'x' * size
+            received = 0
+            start = perf_counter()
+            # keep one window in flight, so the echo does not overflow the receive buffer
+            for sent in range(0, count, window):
+                batch = min(window, count - sent)
+                sock.transmit_many([(data, sam.dest)] * batch)
+                pending = batch
+                while pending:
+                    try:
+                        packets = sock.collect_many(pending, size)
+                    except pysocket.timeout:
+                        break
+                    pending -= len(packets)
+                received += batch - pending
+            elapsed = perf_counter() - start
+            sock.close()
+    return {
+        'packets_per_sec': received / elapsed,
+        'loss': 1 - received / count,
+    }
+
+def bench_dest(count):
+    b64 = Dest(random_keys_cert(), encoding='raw').base64
+    dest = Dest(b64, encoding='base64')
+    return {
+        'parse_per_sec': rate(lambda i: Dest(b64, encoding='base64'), count),
+        'base64_cold_per_sec': rate(lambda i: Dest(b64, encoding='base64').base64, count),
+        'base32_cold_per_sec': rate(lambda i: Dest(b64, encoding='base64').base32, count),
+        'base32_memoized_per_sec': rate(lambda i: dest.base32, count),
+    }
+
+
+def run(latency = 0.0, count = 1000):
+    with FakeSAM(latency=latency) as sam:
+        results = {
+            'handshake': bench_handshake(sam, count),
+            'lookup': bench_lookup(sam, count),
+            'stream': bench_streams(sam, count),
+            'datagram': bench_datagrams(sam, count * 10, 'datagram'),
+            'raw': bench_datagrams(sam, count * 10, 'raw'),
+        }
+    results['dest'] = bench_dest(count * 10)
+    return {
+        'python': platform.python_implementation() + ' ' + platform.python_version(),
+        'platform': platform.platform(),
+        'latency': latency,
+        'count': count,
+        'results': results,
+    }
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(prog='python3 -m leaflet.bench', description=__doc__.split('\n')[0])
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds the fake SAM waits before each reply')
+    parser.add_argument('--count', type=int, default=1000, help='operations per benchmark, ten times that for datagrams')
+    parser.add_argument('--output', help='write the JSON here instead of to stdout')
+    args = parser.parse_args(argv)
+
+    report = run(latency=args.latency, count=args.count)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
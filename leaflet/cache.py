@@ -0,0 +1,166 @@
+import threading
+from collections import OrderedDict
+from time import monotonic, time
+
+from .samtools import Dest
+
+
+class LRUCache(object):
+    """A bounded mapping that evicts the least recently used entry"""
+
+    __slots__ = ('max_entries', 'entries', 'lock', 'evictions')
+
+    def __init__(self, max_entries):
+        if max_entries < 1:
+            raise ValueError('Cache size must be positive')
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key, default = None):
+        with self.lock:
+            try:
+                self.entries.move_to_end(key)
+            except KeyError:
+                return default
+            return self.entries[key]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default = None):
+        with self.lock:
+            return self.entries.pop(key, default)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+default_ns_entries = 10000
+default_ns_ttl = 3600.0
+default_ns_negative_ttl = 60.0
+
+class NSCache(object):
+    """Name service cache with a TTL, LRU eviction and negative caching.
+
+    A resolved name is stored both under the name and under its
+    ``.b32.i2p`` address. A failed lookup is stored as the NSError it
+    raised, for `negative_ttl` seconds.
+
+    An optional `store`, such as an AddressBook, is consulted on a miss
+    and receives every resolved name. What it stored more than `ttl`
+    seconds ago is looked up again.
+    """
+
+    __slots__ = ('entries', 'ttl', 'negative_ttl', 'store', 'hits', 'misses', 'store_hits')
+
+    def __init__(self,
+                 max_entries=default_ns_entries,
+                 ttl=default_ns_ttl,
+                 negative_ttl=default_ns_negative_ttl,
+                 store=None):
+        self.entries = LRUCache(max_entries)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.store = store
+        self.hits = 0
+        self.misses = 0
+        self.store_hits = 0
+
+    @property
+    def evictions(self):
+        return self.entries.evictions
+
+    def get(self, name):
+        """return the cached Dest or NSError of a normalized name, or None"""
+        entry = self.entries.get(name)
+        if entry is not None:
+            expires, value = entry
+            if expires > monotonic():
+                self.hits += 1
+                return value
+            self.entries.pop(name)
+
+        if self.store is not None:
+            entry = self.store.entry(name)
+            if entry is not None:
+                dest, stored_at = entry
+                ttl = self.ttl if stored_at is None else stored_at + self.ttl - time()
+                if ttl > 0:
+                    self.store_hits += 1
+                    self._remember(name, dest, ttl)
+                    return dest
+        self.misses += 1
+        return None
+
+    def _remember(self, name, dest, ttl = None):
+        expires = monotonic() + (self.ttl if ttl is None else ttl)
+        self.entries[name] = (expires, dest)
+        self.entries[dest.base32 + '.b32.i2p'] = (expires, dest)
+
+    def add(self, name, dest):
+        self._remember(name, dest)
+        if self.store is not None:
+            self.store.add(name, dest)
+
+    def add_error(self, name, error):
+        self.entries[name] = (monotonic() + self.negative_ttl, error)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __repr__(self):
+        return '<%s entries=%d hits=%d store_hits=%d misses=%d evictions=%d>' % (
+            self.__class__.__name__, len(self), self.hits, self.store_hits, self.misses, self.evictions)
+
+
+default_intern_entries = 1024
+
+class InternTable(object):
+    """Share one Dest instance per sender, keyed by its raw base64 token.
+
+    A repeat sender skips the base64 decoding and the allocation.
+    """
+
+    __slots__ = ('entries', 'hits', 'misses')
+
+    def __init__(self, max_entries=default_intern_entries):
+        self.entries = LRUCache(max_entries)
+        self.hits = 0
+        self.misses = 0
+
+    def intern(self, token):
+        """return the Dest of a base64 token, given as bytes or str"""
+        dest = self.entries.get(token)
+        if dest is not None:
+            self.hits += 1
+            return dest
+        self.misses += 1
+        if isinstance(token, bytes):
+            dest = Dest(token.decode('ascii'), encoding='base64')
+        else:
+            dest = Dest(token, encoding='base64')
+        self.entries[token] = dest
+        return dest
+
+    def __len__(self):
+        return len(self.entries)
+
+
+__all__ = ('NSCache',)
@@ -1,88 +1,204 @@
 from . import samtools
-from .usersocket import StreamSocket, DatagramSocket
-from socket import SHUT_RDWR
+from .addressbook import AddressBook
+from .cache import NSCache
+from .metrics import Observers
+from .pool import ConnectionPool, DestPool, default_dest_pool_size, default_dest_max_age
+from .usersocket import StreamSocket, DatagramSocket, RawSocket, HeaderSelector, StreamListener
+from socket import SHUT_RDWR, socket, create_connection, timeout as SocketTimeout
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+import logging
 
 default_sam_api = ('127.0.0.1', 7656)
 default_dgram_api = ('127.0.0.1', 7655)
 default_max_version = '3.0'
 default_timeout = 60.0
+default_pool_size = 2
+default_pool_idle = 30.0
 
-def sam_handshake(func):
-    def f(self, *args, **kwargs):
-        sock = samtools.handshake(*self.handshake_args)
-        return func(self, sock, *args, **kwargs)
-    return f
+log = logging.getLogger(__name__)
 
 def transient_handshake(func):
     def f(self, *args, **kwargs):
-        with samtools.context_handshake(*self.handshake_args) as sock:
+        with self.pool.connection() as sock:
             return func(self, sock, *args, **kwargs)
     return f
 
 class Controller(object):
-    __slots__ = ('sam_timeout', 'sam_api', 'dgram_api', 'max_version', 'ns_cache')
+    __slots__ = ('sam_timeout', 'sam_api', 'dgram_api', 'max_version', 'ns_cache', 'pool', 'observers',
+        'own_address_book')
 
     def __init__(self,
                  sam_timeout=default_timeout,
                  sam_api=default_sam_api,
                  dgram_api=default_dgram_api,
-                 max_version=default_max_version):
+                 max_version=default_max_version,
+                 ns_cache=None,
+                 pool_size=default_pool_size,
+                 pool_idle=default_pool_idle,
+                 address_book=None):
         self.sam_timeout = sam_timeout
         self.sam_api = sam_api
         self.dgram_api = dgram_api
         self.max_version = max_version
-        self.ns_cache = dict()
+        self.ns_cache = NSCache() if ns_cache is None else ns_cache
+        # an AddressBook opened from a path is ours to close, one passed in is not
+        self.own_address_book = None
+        if address_book is not None:
+            if not isinstance(address_book, AddressBook):
+                address_book = self.own_address_book = AddressBook(address_book)
+            self.ns_cache.store = address_book
+        self.observers = Observers()
+        self.pool = ConnectionPool(self.handshake_args, size=pool_size, idle_timeout=pool_idle)
 
         self.check_api()
 
     @property
     def handshake_args(self):
-        return (self.sam_timeout, self.sam_api, self.max_version)
+        return (self.sam_timeout, self.sam_api, self.max_version, self.observers)
 
     @transient_handshake
     def check_api(self, sam_sock):
         pass
 
     def lookup(self, name):
+        if isinstance(name, samtools.Dest):
+            return name
         dest = samtools.lookup_cache(name, self.ns_cache)
         if dest:
+            if self.observers:
+                self.observers.emit('ns_cache_hits', 1)
             return dest
         else:
             return self._lookup(name)
 
     @transient_handshake
     def _lookup(self, sam_sock, name):
-        return samtools.lookup(sam_sock, name, self.ns_cache)
+        if not self.observers:
+            return samtools.lookup(sam_sock, name, self.ns_cache)
+        self.observers.emit('ns_cache_misses', 1)
+        with self.observers.timed('lookup'):
+            return samtools.lookup(sam_sock, name, self.ns_cache)
+
+    def lookup_many(self, names, timeout = None):
+        """resolve many names at once, returning a dict of name -> Dest or error.
+
+        Names still unresolved after `timeout` seconds map to socket.timeout.
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        results = {}
+        misses = {}
+        for name in names:
+            if name in results:
+                continue
+            try:
+                dest = samtools.lookup_cache(name, self.ns_cache)
+            except (TypeError, ValueError, samtools.NSError) as e:
+                results[name] = e
+                continue
+            if dest:
+                results[name] = dest
+            else:
+                misses.setdefault(samtools.normalize_domain(name), []).append(name)
+                results[name] = None
+
+        if self.observers:
+            # a name that failed to parse, or a Dest given as is, counts as neither
+            misses_count = sum(len(names) for names in misses.values())
+            hits_count = sum(1 for (name, result) in results.items()
+                             if isinstance(result, samtools.Dest) and not isinstance(name, samtools.Dest))
+            if hits_count:
+                self.observers.emit('ns_cache_hits', hits_count)
+            if misses_count:
+                self.observers.emit('ns_cache_misses', misses_count)
+
+        if misses:
+            try:
+                self._lookup_many(misses, results, timeout, deadline)
+            except SocketTimeout as e:
+                if deadline is None:
+                    raise
+                for names in misses.values():
+                    for name in names:
+                        if results[name] is None:
+                            results[name] = e
+        return results
+
+    def _lookup_many(self, misses, results, timeout, deadline):
+        with self.pool.connection(timeout) as sam_sock, self.observers.timed('lookup_many'):
+            self._run_lookups(sam_sock, misses, results, deadline)
+
+    def _run_lookups(self, sam_sock, misses, results, deadline = None):
+        lookups = samtools.lookup_pipelined(sam_sock, misses, self.ns_cache)
+        while True:
+            if deadline is not None:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    # the socket is closed with the replies still in flight
+                    raise SocketTimeout('NAMING LOOKUP timed out')
+                sam_sock.settimeout(remaining)
+            try:
+                (domain, result) = next(lookups)
+            except StopIteration:
+                break
+            for name in misses[domain]:
+                results[name] = result
+        if deadline is not None:
+            sam_sock.settimeout(self.sam_timeout)
+
+    def create_dest(self, name = None, style='stream', forward = None, i2cp = None, keyfile = None):
+        return OurDest(controller=self, name=name, style=style, forward=forward, i2cp=i2cp, keyfile=keyfile)
+
+    def create_dest_pool(self, size=default_dest_pool_size, style='stream', i2cp = None, max_age=default_dest_max_age):
+        return DestPool(controller=self, size=size, style=style, i2cp=i2cp, max_age=max_age)
 
-    def create_dest(self, name = None, style='stream', forward = None, i2cp = None):
-        return OurDest(controller=self, name=name, style=style, forward=forward, i2cp=i2cp)
+    def close(self):
+        self.pool.close()
+        if self.own_address_book is not None:
+            self.own_address_book.close()
 
+    def __enter__(self):
+        return self
 
-class OurDest(samtools.Dest):
-    __slots__ = ('name', 'sam_sock', 'controller', 'style', 'forward')
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def check_dest_options(name, style, forward):
+    """validate and normalize the options of a new Destination"""
+    if style not in ('stream', 'datagram', 'dgram', 'raw', 'primary'):
+        raise NotImplementedError('Socket type %s is not implemented' % repr(style))
 
-    def __init__(self, controller, name, style, forward, i2cp):
-        if style not in ('stream', 'datagram', 'dgram'):
-            raise NotImplementedError('Socket type %s is not implemented' % repr(style))
+    if not name:
+        name = samtools.random_name()
+    else:
+        samtools.check_name(name)
 
-        if not name:
-            name = samtools.random_name()
+    if style == 'dgram':
+        style = 'datagram'
+
+    if forward is not None:
+        if style == 'primary':
+            raise ValueError('Forward the subsessions of a primary session instead')
+        if isinstance(forward, int):
+            forward = ('127.0.0.1', forward)
         else:
-            samtools.check_name(name)
+            samtools.check_forward(forward)
 
-        if style == 'dgram':
-            style = 'datagram'
+    return (name, style, forward)
 
-        if forward is not None:
-            if isinstance(forward, int):
-                forward = ('127.0.0.1', forward)
-            else:
-                samtools.check_forward(forward)
 
-        self.__real_init(controller=controller, name=name, style=style, forward=forward, i2cp=i2cp or {})
+class OurDest(samtools.Dest):
+    __slots__ = ('name', 'sam_sock', 'controller', 'style', 'forward')
 
+    def __init__(self, controller, name, style, forward, i2cp, keyfile = None):
+        name, style, forward = check_dest_options(name, style, forward)
+        self.__real_init(controller=controller, name=name, style=style, forward=forward, i2cp=i2cp or {},
+            keyfile=keyfile)
 
-    def __real_init(self, controller, name, style, forward, i2cp):
+
+    def __real_init(self, controller, name, style, forward, i2cp, keyfile):
         self.controller = controller
         self.name = name
         self.style = style
@@ -90,13 +206,33 @@ class OurDest(samtools.Dest):
 
         if forward:
             i2cp['HOST'], i2cp['PORT'] = forward
-        sig_type = self.default_sig_type
-        sock = samtools.handshake(*controller.handshake_args)
-        keyfile = samtools.session_create(sock, style, sig_type, name, i2cp)
+        private_key = samtools.load_keyfile(keyfile) if keyfile else None
+        if private_key:
+            sig_type = self.read_sig_type(private_key)
+        else:
+            sig_type = self.default_sig_type
+        sock = controller.pool.take()
+        if style == 'primary' and samtools.version_tuple(sock.version) < (3, 3):
+            sock.close()
+            raise NotImplementedError('Primary sessions need SAM 3.3, but SAM %s was negotiated with max_version=%s'
+                % (sock.version, controller.max_version))
+        try:
+            with controller.observers.timed('session_create'):
+                reply_key = samtools.session_create(sock, style, sig_type, name, i2cp, private_key)
+            super().__init__(reply_key, sig_type=sig_type, encoding='base64', private=True)
+        except BaseException:
+            sock.close()
+            raise
         self.sam_sock = sock
+        if keyfile and not private_key:
+            samtools.save_keyfile(keyfile, self.private_key)
 
-        super().__init__(keyfile, sig_type=sig_type, encoding='base64', private=True)
 
+    def add_subsession(self, style='stream', name = None, forward = None, listen_port = None, options = None):
+        """For primary Destinations. Add a subsession that shares our tunnels."""
+        if self.style != 'primary':
+            raise NotImplementedError('Only primary sessions have subsessions')
+        return SubDest(self, name=name, style=style, forward=forward, listen_port=listen_port, options=options)
 
     @property
     def handshake_args(self):
@@ -104,31 +240,189 @@ class OurDest(samtools.Dest):
 
     def connect(self, other):
         dest = self.controller.lookup(other)
-        s = samtools.handshake(*self.handshake_args)
+        s = self.controller.pool.take()
         parser = samtools.stream_connect(self.name, dest)
         return StreamSocket(s, self.controller, parser)
 
+    def connect_many(self, targets, timeout = None, concurrency=32):
+        """Connect to many peers at once.
+
+        Yield (target, StreamSocket or exception) as connections finish,
+        with at most `concurrency` STREAM CONNECTs in flight. Each target
+        gets `timeout` seconds from the moment connect_many is called, lookups
+        and handshakes included.
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        queue = deque(targets)
+        dests = self.controller.lookup_many(queue, timeout)
+        selector = HeaderSelector()
+        waiting = {}
+        try:
+            while queue or waiting:
+                batch = []
+                while queue and len(waiting) + len(batch) < concurrency:
+                    target = queue.popleft()
+                    dest = dests[target]
+                    if isinstance(dest, Exception):
+                        yield (target, dest)
+                    else:
+                        batch.append((target, dest))
+
+                if batch:
+                    remaining = None if deadline is None else deadline - monotonic()
+                    try:
+                        if remaining is not None and remaining <= 0:
+                            raise SocketTimeout('STREAM CONNECT timed out')
+                        socks = self.controller.pool.take_many(len(batch), remaining)
+                    except (OSError, EOFError) as e:
+                        for (target, dest) in batch:
+                            yield (target, e)
+                        continue
+                    if deadline is not None:
+                        remaining = max(0.0, deadline - monotonic())
+                    for ((target, dest), s) in zip(batch, socks):
+                        sock = StreamSocket(s, self.controller, samtools.stream_connect(self.name, dest))
+                        waiting[sock] = target
+                        selector.register(sock, remaining)
+
+                if waiting:
+                    for (sock, result) in selector.select():
+                        target = waiting.pop(sock)
+                        yield (target, result if isinstance(result, BaseException) else sock)
+        finally:
+            selector.close()
+
     def register_accept(self):
-        s = samtools.handshake(*self.handshake_args)
+        s = self.controller.pool.take()
         parser = samtools.stream_accept(self.name)
         return StreamSocket(s, self.controller, parser)
 
+    def serve(self, handler, backlog=4, workers=8):
+        """Accept streams forever, calling handler(addr, conn) in a thread pool.
+
+        `backlog` STREAM ACCEPTs are kept registered at all times. Each one
+        that turns into a connection is replaced right away. `conn` is closed
+        once the handler returns, and an exception it raises is logged.
+        """
+        selector = HeaderSelector()
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            first = self.register_accept()
+            selector.register(first)
+            if samtools.version_tuple(first.sock.version or '3.0') < (3, 2):
+                # older routers refuse a second pending STREAM ACCEPT with ALREADY_ACCEPTING
+                backlog = 1
+            for i in range(backlog - 1):
+                selector.register(self.register_accept())
+
+            while True:
+                for (conn, addr) in selector.select():
+                    selector.register(self.register_accept())
+                    if isinstance(addr, samtools.AcceptError):
+                        raise addr
+                    elif isinstance(addr, BaseException):
+                        # this accept died, it has been replaced
+                        continue
+                    executor.submit(run_handler, handler, addr, conn)
+        finally:
+            selector.close()
+            executor.shutdown(wait=False)
+
+    def serve_tunnel(self, local, backlog=4, workers=64):
+        """Expose a local TCP service: relay every incoming stream to `local`, a (host, port) pair"""
+        def handler(addr, conn):
+            try:
+                local_sock = create_connection(local)
+            except OSError:
+                conn.close()
+                return
+            with local_sock:
+                try:
+                    conn.relay(local_sock)
+                finally:
+                    conn.close()
+        self.serve(handler, backlog=backlog, workers=workers)
+
+    def client_tunnel(self, other, local, backlog=128, workers=64):
+        """Relay every TCP connection to `local` to a new stream to `other`, forever.
+
+        `local` is a (host, port) pair to listen on, or a listening socket.
+        """
+        if isinstance(local, socket):
+            listener = local
+        else:
+            listener = socket()
+            listener.bind(local)
+            listener.listen(backlog)
+        dest = self.controller.lookup(other)
+
+        def handler(local_sock):
+            with local_sock:
+                try:
+                    conn = self.connect(dest)
+                except (OSError, EOFError):
+                    return
+                try:
+                    conn.parse_headers()
+                    conn.relay(local_sock)
+                except (OSError, EOFError):
+                    pass
+                finally:
+                    conn.close()
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            with listener:
+                while True:
+                    local_sock, address = listener.accept()
+                    executor.submit(handler, local_sock)
+        finally:
+            executor.shutdown(wait=False)
+
+    def forward_streams(self, port = 0, host = '127.0.0.1', backlog=128):
+        """Ask SAM to forward incoming streams to a local TCP listener, and return it"""
+        listener = socket()
+        try:
+            listener.bind((host, port))
+            listener.listen(backlog)
+            forward = listener.getsockname()[0:2]
+            samtools.check_forward(forward)
+            sam_sock = self.controller.pool.take()
+        except BaseException:
+            listener.close()
+            raise
+        try:
+            samtools.sam_run(sam_sock, samtools.stream_forward(self.name, forward))
+        except BaseException:
+            sam_sock.close()
+            listener.close()
+            raise
+        return StreamListener(listener, sam_sock, self.controller)
+
     def bind(self):
         if self.forward:
             return self._bind_datagram()
         else:
             return self._bind_legacy_datagram()
 
+    def _datagram_class(self):
+        return RawSocket if self.style == 'raw' else DatagramSocket
+
     def _bind_datagram(self):
         sock = samtools.bind_datagram(self.forward)
-        return DatagramSocket(sock, self.controller, self.name, parser=None)
+        return self._datagram_class()(sock, self.controller, self.name)
 
     def _bind_legacy_datagram(self):
-        raise NotImplementedError('Legacy DATAGRAM SEND is not implemented')
+        # datagrams travel over our SAM session socket
+        return self._datagram_class()(self.sam_sock, self.controller, self.name, forward_mode=False)
 
     def close(self):
-        if self.sam_sock:
-            self.sam_sock.shutdown(SHUT_RDWR)
+        if self.sam_sock and self.sam_sock.fileno() >= 0:
+            try:
+                self.sam_sock.shutdown(SHUT_RDWR)
+            except OSError:
+                # SAM hung up already
+                pass
             self.sam_sock.close()
 
     def __enter__(self):
@@ -138,4 +432,47 @@ class OurDest(samtools.Dest):
         self.close()
 
 
+
+class SubDest(OurDest):
+    """A subsession of a SAM 3.3 primary session, sharing its keys and tunnels"""
+
+    __slots__ = ('primary',)
+
+    def __init__(self, primary, name, style, forward, listen_port, options):
+        if style == 'primary':
+            raise NotImplementedError('Subsessions cannot be primary sessions')
+        name, style, forward = check_dest_options(name, style, forward)
+        if style in ('datagram', 'raw') and forward is None:
+            # no session socket of its own to carry the datagrams
+            raise ValueError('A %s subsession needs a forward port' % style)
+        options = dict(options or {})
+        if forward:
+            options['HOST'], options['PORT'] = forward
+        if listen_port is not None:
+            options['LISTEN_PORT'] = listen_port
+        samtools.sam_run(primary.sam_sock, samtools.session_add(style, name, options))
+
+        self.primary = primary
+        self.controller = primary.controller
+        self.name = name
+        self.style = style
+        self.forward = forward
+        self.sam_sock = None
+        for attr in ('keys_cert', 'secret_key', 'signing_secret_key', 'sig_type', '_base64', '_base32', '_digest'):
+            setattr(self, attr, getattr(primary, attr))
+
+    def close(self):
+        """remove this subsession, the primary session stays up"""
+        if self.primary.sam_sock.fileno() >= 0:
+            samtools.sam_run(self.primary.sam_sock, samtools.session_remove(self.name))
+
+def run_handler(handler, addr, conn):
+    try:
+        handler(addr, conn)
+    except Exception:
+        log.exception('Handler of the stream from %s failed', addr)
+    finally:
+        conn.close()
+
+
 __all__ = ('Controller',)
@@ -0,0 +1,174 @@
+"""Instrumentation hooks: timings of SAM phases and counts of what went through.
+
+Every observation is a (name, value) pair handed to the subscribed
+callbacks. Timings are in seconds:
+
+- ``connect``, ``handshake``: TCP connect and HELLO of a new SAM socket
+- ``lookup``: one NAMING LOOKUP, ``lookup_many``: one pipelined batch of them
+- ``ns_cache_hits``, ``ns_cache_misses``: numbers of names, summed
+- ``session_create``: a SESSION CREATE
+- ``stream_connect``, ``stream_accept``: from sending the command to the parsed STREAM STATUS
+- ``dgram_sent``, ``dgram_received``: bytes of payload, once per datagram
+
+A failed phase is timed as well, and also counts 1 under its name plus ``_errors``.
+"""
+
+import threading
+from math import frexp
+from time import monotonic
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+null_timer = _NullTimer()
+
+
+class _Timer(object):
+    __slots__ = ('observers', 'name', 'start')
+
+    def __init__(self, observers, name):
+        self.observers = observers
+        self.name = name
+
+    def __enter__(self):
+        self.start = monotonic()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.observers.emit(self.name, monotonic() - self.start)
+        if type is not None:
+            self.observers.emit(self.name + '_errors', 1)
+        return False
+
+
+class Observers(object):
+    """The callbacks subscribed to a Controller.
+
+    It is false while nobody is subscribed, so producers can skip even
+    reading the clock with a plain ``if observers:``.
+    """
+
+    __slots__ = ('callbacks',)
+
+    def __init__(self):
+        # replaced, never mutated, so emitting needs no lock
+        self.callbacks = ()
+
+    def __bool__(self):
+        return bool(self.callbacks)
+
+    def subscribe(self, callback):
+        """call callback(name, value) for every observation from now on"""
+        self.callbacks += (callback,)
+
+    def unsubscribe(self, callback):
+        self.callbacks = tuple(c for c in self.callbacks if c is not callback)
+
+    def emit(self, name, value):
+        for callback in self.callbacks:
+            callback(name, value)
+
+    def timed(self, name):
+        """a context manager which reports how long its block took"""
+        if not self.callbacks:
+            return null_timer
+        return _Timer(self, name)
+
+# for callers that have no Controller at hand
+no_observers = Observers()
+
+
+class Histogram(object):
+    """Count, sum and extremes of observed values, with power-of-two buckets"""
+
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        # values in [2**(e-1), 2**e) share bucket e
+        exponent = frexp(value)[1] if value > 0 else None
+        self.buckets[exponent] = self.buckets.get(exponent, 0) + 1
+
+    def quantile(self, q):
+        """an upper bound of the q-quantile, exact to a factor of two"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for exponent in sorted(self.buckets, key=lambda e: float('-inf') if e is None else e):
+            seen += self.buckets[exponent]
+            if seen >= rank:
+                if exponent is None:
+                    return self.min
+                return min(2.0 ** exponent, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+        }
+
+
+class Metrics(object):
+    """A registry of one Histogram per observed name.
+
+    Subscribe it to ``Controller.observers``, then read `snapshot`.
+    """
+
+    __slots__ = ('histograms', 'lock')
+
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(value)
+
+    def __getitem__(self, name):
+        return self.histograms[name]
+
+    def snapshot(self):
+        """a dict of name -> histogram summary, plus the name cache hit rate"""
+        with self.lock:
+            result = {name: h.as_dict() for (name, h) in self.histograms.items()}
+        hits = result.get('ns_cache_hits', {}).get('sum', 0)
+        misses = result.get('ns_cache_misses', {}).get('sum', 0)
+        if hits + misses:
+            result['ns_cache_hit_rate'] = hits / (hits + misses)
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.histograms.clear()
+
+
+__all__ = ('Observers', 'Metrics')
@@ -0,0 +1,254 @@
+import threading
+from collections import deque
+from contextlib import contextmanager
+from socket import MSG_PEEK
+from time import monotonic
+
+from . import samtools
+
+
+def is_alive(sock):
+    """True if an idle SAM socket is still open and has nothing unread"""
+    if sock.read_buffer:
+        return False
+    timeout = sock.gettimeout()
+    try:
+        sock.setblocking(False)
+        sock.recv(1, MSG_PEEK)
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    else:
+        # either EOF or a stray reply, neither is reusable
+        return False
+    finally:
+        sock.settimeout(timeout)
+
+
+class ConnectionPool(object):
+    """Keep up to `size` handshaked SAM sockets warm.
+
+    Sockets lent out by `connection` come back to the pool. Sockets given
+    away by `take` are used up (SAM hands them off to a stream or a
+    session), so the pool opens replacements in the background.
+    """
+
+    __slots__ = ('handshake_args', 'size', 'idle_timeout', 'idle', 'lock', 'filling', 'closed')
+
+    def __init__(self, handshake_args, size, idle_timeout):
+        self.handshake_args = handshake_args
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.idle = deque()
+        self.lock = threading.Lock()
+        self.filling = False
+        self.closed = False
+
+    def __len__(self):
+        return len(self.idle)
+
+    def _pop(self):
+        deadline = monotonic() - self.idle_timeout
+        stale = []
+        sock = None
+        with self.lock:
+            # oldest sockets are on the left
+            while self.idle and self.idle[0][1] < deadline:
+                stale.append(self.idle.popleft()[0])
+            while self.idle:
+                candidate = self.idle.pop()[0]
+                if is_alive(candidate):
+                    sock = candidate
+                    break
+                stale.append(candidate)
+        for s in stale:
+            s.close()
+        return sock
+
+    def _handshake_args(self, timeout):
+        args = self.handshake_args
+        if timeout is not None and (args[0] is None or timeout < args[0]):
+            # a shorter timeout bounds each step of the handshake
+            args = (timeout,) + args[1:]
+        return args
+
+    def get(self, timeout = None):
+        """return a handshaked socket, from the pool if possible"""
+        return self._pop() or samtools.handshake(*self._handshake_args(timeout))
+
+    def put(self, sock):
+        """return a socket to the pool, or close it if the pool is full"""
+        with self.lock:
+            if not self.closed and len(self.idle) < self.size:
+                self.idle.append((sock, monotonic()))
+                return
+        sock.close()
+
+    @contextmanager
+    def connection(self, timeout = None):
+        """lend a socket for a few commands, then put it back"""
+        sock = self.get(timeout)
+        try:
+            yield sock
+        except samtools.NSError:
+            # a complete reply was read, the socket is still usable
+            self.put(sock)
+            raise
+        except BaseException:
+            sock.close()
+            raise
+        self.put(sock)
+
+    def take(self):
+        """return a handshaked socket for good, and open a replacement ahead of time"""
+        sock = self.get()
+        self.refill()
+        return sock
+
+    def take_many(self, count, timeout = None):
+        """like take, but handshake the missing sockets concurrently"""
+        socks = []
+        while len(socks) < count:
+            sock = self._pop()
+            if sock is None:
+                break
+            socks.append(sock)
+        if len(socks) < count:
+            try:
+                socks += samtools.handshake_many(count - len(socks), *self._handshake_args(timeout))
+            except BaseException:
+                for sock in socks:
+                    sock.close()
+                raise
+        self.refill()
+        return socks
+
+    def refill(self):
+        with self.lock:
+            if self.filling or self.closed or len(self.idle) >= self.size:
+                return
+            self.filling = True
+        threading.Thread(target=self._fill, daemon=True).start()
+
+    def _fill(self):
+        try:
+            while True:
+                with self.lock:
+                    if self.closed or len(self.idle) >= self.size:
+                        return
+                self.put(samtools.handshake(*self.handshake_args))
+        except (OSError, EOFError):
+            # SAM is unreachable. The next get() will tell the caller.
+            pass
+        finally:
+            with self.lock:
+                self.filling = False
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, deque()
+        for (sock, since) in idle:
+            sock.close()
+
+
+default_dest_pool_size = 2
+default_dest_max_age = 600.0
+retry_delay = 5.0
+
+class DestPool(object):
+    """Keep `size` transient Destinations created ahead of time.
+
+    SESSION CREATE builds tunnels, which can take tens of seconds. A
+    background thread creates Destinations before they are needed, and
+    retires those that waited longer than `max_age` seconds.
+    """
+
+    __slots__ = ('controller', 'size', 'style', 'i2cp', 'max_age', 'ready', 'cond', 'closed')
+
+    def __init__(self, controller, size, style, i2cp, max_age):
+        if size < 1:
+            raise ValueError('Destination pool size must be positive')
+        self.controller = controller
+        self.size = size
+        self.style = style
+        self.i2cp = i2cp or {}
+        self.max_age = max_age
+        self.ready = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def __len__(self):
+        return len(self.ready)
+
+    def _create(self):
+        return self.controller.create_dest(style=self.style, i2cp=dict(self.i2cp))
+
+    def _expired(self):
+        """pop the Destinations past their age, with self.cond held"""
+        deadline = monotonic() - self.max_age
+        expired = []
+        while self.ready and self.ready[0][1] < deadline:
+            expired.append(self.ready.popleft()[0])
+        return expired
+
+    def get(self):
+        """return a ready Destination, or create one if none is ready"""
+        dest = None
+        with self.cond:
+            expired = self._expired()
+            if self.ready:
+                dest = self.ready.popleft()[0]
+            self.cond.notify()
+        for d in expired:
+            d.close()
+        return dest or self._create()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.closed and len(self.ready) >= self.size:
+                    self.cond.wait(self.ready[0][1] + self.max_age - monotonic())
+                    expired = self._expired()
+                    if expired:
+                        break
+                else:
+                    expired = []
+                closed = self.closed
+            for d in expired:
+                d.close()
+            if closed:
+                return
+            if len(self.ready) >= self.size:
+                continue
+
+            try:
+                dest = self._create()
+            except (OSError, EOFError):
+                # SAM is unreachable, get() will tell the caller
+                with self.cond:
+                    self.cond.wait(retry_delay)
+                continue
+
+            with self.cond:
+                if not self.closed:
+                    self.ready.append((dest, monotonic()))
+                    continue
+            dest.close()
+
+    def close(self):
+        """stop refilling, and close the Destinations nobody took"""
+        with self.cond:
+            self.closed = True
+            ready, self.ready = self.ready, deque()
+            self.cond.notify()
+        for (dest, created) in ready:
+            dest.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
@@ -0,0 +1,235 @@
+"""Sans-IO SAM connection: feed it the bytes you receive, send the bytes it returns.
+
+It never touches a socket, so one state machine serves blocking sockets,
+selectors, asyncio or anything else that can move bytes. Commands are the
+generator parsers of samtools, such as ``hello``, ``naming_lookup``,
+``session_setup``, ``stream_connect`` or ``datagram_send``.
+"""
+
+import errno
+from collections import deque
+
+from .samtools import Dest, sam_pack, sam_parse_reply
+
+
+class ProtocolError(OSError):
+    def __init__(self, msg):
+        super().__init__(errno.EPROTO, msg)
+
+
+# connection states
+IDLE = 'IDLE'            # nothing sent yet, HELLO has to come first
+CONTROL = 'CONTROL'      # SAM commands and replies, several may be in flight
+STREAM = 'STREAM'        # a STREAM CONNECT or ACCEPT succeeded, bytes are payload now
+CLOSED = 'CLOSED'
+
+# commands that SAM does not answer
+no_reply_verbs = ('DATAGRAM SEND', 'RAW SEND', 'PONG')
+# commands that turn the connection into a stream once they succeed
+stream_verbs = ('STREAM CONNECT', 'STREAM ACCEPT')
+received_verbs = (b'DATAGRAM RECEIVED', b'RAW RECEIVED')
+
+max_line_len = 64 * 1024
+
+
+def split_frame(buf, verbs = received_verbs):
+    """take the next line, or DATAGRAM or RAW RECEIVED frame, off the front of buf.
+
+    Returns (reply, payload) for a frame starting with one of `verbs`,
+    (line, None) for any other line, or (None, needed) while buf holds no
+    whole line or frame, `needed` being the missing byte count once known.
+    Nothing is consumed from buf until a whole frame is there.
+    """
+    lf_index = buf.find(b'\n')
+    if lf_index < 0:
+        if len(buf) > max_line_len:
+            raise ProtocolError('SAM reply line is too long')
+        return (None, None)
+    line = bytes(buf[0:lf_index])
+
+    if line.startswith(verbs):
+        reply = sam_parse_reply(line)
+        end = 1 + lf_index + int(reply['SIZE'])
+        if len(buf) < end:
+            return (None, end - len(buf))
+        data = bytes(buf[1+lf_index:end])
+        del buf[0:end]
+        return (reply, data)
+
+    del buf[0:1+lf_index]
+    return (line, None)
+
+
+class Event(object):
+    __slots__ = ()
+
+    def __repr__(self):
+        fields = ''.join(' %s=%r' % (name, getattr(self, name)) for name in self.__slots__)
+        return '<%s%s>' % (self.__class__.__name__, fields)
+
+class CommandComplete(Event):
+    """the command sent as `request` finished with `result`"""
+    __slots__ = ('request', 'result')
+
+    def __init__(self, request, result):
+        self.request = request
+        self.result = result
+
+class CommandFailed(Event):
+    """the command sent as `request` raised `error`"""
+    __slots__ = ('request', 'error')
+
+    def __init__(self, request, error):
+        self.request = request
+        self.error = error
+
+class DatagramReceived(Event):
+    """a DATAGRAM RECEIVED or RAW RECEIVED frame"""
+    __slots__ = ('reply', 'data')
+
+    def __init__(self, reply, data):
+        self.reply = reply
+        self.data = data
+
+    @property
+    def source(self):
+        """the Dest of the sender, or None for raw datagrams"""
+        b64 = self.reply.get('DESTINATION')
+        return None if b64 is None else Dest(b64, encoding='base64')
+
+class Ping(Event):
+    """a keepalive, answer it with SAMConnection.pong"""
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text
+
+class StreamData(Event):
+    """payload bytes of an open stream"""
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+class ConnectionClosed(Event):
+    __slots__ = ()
+
+
+class _Command(object):
+    __slots__ = ('request', 'parser')
+
+    def __init__(self, request, parser):
+        self.request = request
+        self.parser = parser
+
+
+class SAMConnection(object):
+    """The state of one SAM connection, without any I/O.
+
+    `send` takes a command generator and returns the bytes to write.
+    `receive_data` takes whatever bytes arrived, in chunks of any size,
+    and returns a list of events. Replies are matched to the commands in
+    the order they were sent, so commands may be pipelined.
+    """
+
+    __slots__ = ('state', 'version', 'buffer', 'pending')
+
+    def __init__(self):
+        self.state = IDLE
+        # the SAM version agreed on in the handshake
+        self.version = None
+        self.buffer = bytearray()
+        self.pending = deque()
+
+    def send(self, command):
+        """return the bytes of a command, or of stream payload once in the STREAM state"""
+        if self.state is CLOSED:
+            raise ProtocolError('SAM connection is closed')
+        if self.state is STREAM:
+            if not isinstance(command, (bytes, bytearray, memoryview)):
+                raise ProtocolError('Only payload can be sent over an open stream')
+            return bytes(command)
+
+        request = next(command)
+        line = request[0] if isinstance(request, tuple) else request
+        if self.state is IDLE:
+            if not line.startswith('HELLO'):
+                raise ProtocolError('Say HELLO before %r' % line)
+            self.state = CONTROL
+        if not line.startswith(no_reply_verbs):
+            self.pending.append(_Command(line, command))
+        return sam_pack(request)
+
+    def pong(self, ping):
+        """return the bytes answering a Ping event"""
+        if self.state is not CONTROL:
+            raise ProtocolError('Cannot answer a PING in the %s state' % self.state)
+        return sam_pack('PONG' + ping.text)
+
+    def receive_data(self, data):
+        """feed received bytes, an empty string meaning the peer closed, returning events"""
+        if self.state is CLOSED:
+            raise ProtocolError('SAM connection is closed')
+        if not data:
+            return self._close()
+        if self.state is STREAM:
+            return [StreamData(bytes(data))]
+
+        self.buffer += data
+        events = []
+        while self.state is not STREAM:
+            event = self._next_event()
+            if event is False:
+                break
+            elif event is not None:
+                events.append(event)
+
+        if self.state is STREAM and self.buffer:
+            # payload that came right behind the reply
+            events.append(StreamData(bytes(self.buffer)))
+            self.buffer.clear()
+        return events
+
+    def _close(self):
+        events = [CommandFailed(command.request, EOFError('SAM connection died'))
+                  for command in self.pending]
+        events.append(ConnectionClosed())
+        self.pending.clear()
+        self.state = CLOSED
+        return events
+
+    def _next_event(self):
+        """return an event, None if a line gave no event, or False if more bytes are needed"""
+        line, data = split_frame(self.buffer)
+        if line is None:
+            return False
+        if data is not None:
+            return DatagramReceived(line, data)
+
+        line = line.decode('ascii').rstrip(' \r')
+        if line.startswith('PING'):
+            return Ping(line[4:])
+        if not self.pending:
+            raise ProtocolError('Unexpected SAM reply %r' % line)
+
+        command = self.pending[0]
+        try:
+            result = command.parser.send(line)
+        except OSError as e:
+            self.pending.popleft()
+            if command.request.startswith('HELLO'):
+                self.state = IDLE
+            return CommandFailed(command.request, e)
+        if result is None:
+            # the command waits for another line
+            return None
+
+        self.pending.popleft()
+        if command.request.startswith('HELLO'):
+            self.version = result.get('VERSION', '3.0')
+        elif command.request.startswith(stream_verbs):
+            self.state = STREAM
+        return CommandComplete(command.request, result)
+
+
+__all__ = ('SAMConnection', 'ProtocolError', 'split_frame')
@@ -3,15 +3,22 @@ import struct
 import base64
 import string
 import errno
+import os
+import re
+from collections import deque
 from random import SystemRandom
-from contextlib import contextmanager
 from hashlib import sha256
 from io import BytesIO
 
+from .metrics import no_observers
+
 
 def greet(max_version):
     return 'HELLO VERSION MIN=3.0 MAX=%s' % max_version
 
+def version_tuple(version):
+    return tuple(int(n) for n in version.split('.'))
+
 def random_name(l=20):
     nick = 'leaflet-'
     rng = SystemRandom()
@@ -55,6 +62,8 @@ def check_domain(domain):
     check_invalid_chars(domain, domain_chars)
 
 def normalize_domain(domain):
+    if not isinstance(domain, str):
+        raise TypeError('A domain name must be a str, not %s' % type(domain).__name__)
     domain = domain.lower()
     check_domain(domain)
     return domain
@@ -62,32 +71,82 @@ def normalize_domain(domain):
 
 ########## SAM header parser ##########
 
-def sam_readline(sock, partial = None):
-    """read a line from a sam control socket"""
-    response = b''
-    exception = None
-    while True:
-        try:
-            c = sock.recv(1)
-            if not c:
-                raise EOFError('SAM connection died. Partial response %r %r' % (partial, response))
-            elif c == b'\n':
-                break
-            else:
-                response += c
-        except (BlockingIOError, pysocket.timeout) as e:
-            if partial is None:
-                raise e
-            else:
-                exception = e
+class SAMSocket(pysocket.socket):
+    """A SAM control socket that reads reply lines in large chunks.
+
+    Bytes received past the end of a reply line are kept in `read_buffer`
+    and handed out first by `recv` and `recv_into`, so the first bytes of a
+    stream payload are never lost.
+    """
+
+    __slots__ = ('read_buffer', 'version')
+
+    chunk_size = 4096
+
+    def __init__(self, *args, **kwargs):
+        self.read_buffer = bytearray()
+        # the SAM version agreed on in the handshake
+        self.version = None
+        super().__init__(*args, **kwargs)
+
+    def _fill_buffer(self, size = None):
+        chunk = super().recv(max(size or 0, self.chunk_size))
+        self.read_buffer += chunk
+        return len(chunk)
+
+    def readline(self, partial = None):
+        """read a line, keeping whatever follows it in the buffer"""
+        buf = self.read_buffer
+        start = 0
+        while True:
+            lf_index = buf.find(b'\n', start)
+            if lf_index >= 0:
                 break
+            start = len(buf)
+            try:
+                received = self._fill_buffer()
+            except (BlockingIOError, pysocket.timeout) as e:
+                if partial is None:
+                    raise e
+                else:
+                    # incomplete bytes stay in the buffer for the next call
+                    return (partial, e)
+            if not received:
+                raise EOFError('SAM connection died. Partial response %r %r' % (partial, bytes(buf)))
+
+        response = buf[:lf_index].decode('ascii')
+        del buf[:lf_index+1]
+        if partial is None:
+            # print('<--', response)
+            return response
+        else:
+            # print('<--', repr(partial), '+', response)
+            return (partial + response, None)
+
+    def recv(self, bufsize, flags = 0):
+        buf = self.read_buffer
+        if not buf:
+            return super().recv(bufsize, flags)
+        data = bytes(buf[:bufsize])
+        if not flags & pysocket.MSG_PEEK:
+            del buf[:bufsize]
+        return data
 
-    if partial is None:
-        # print('<--', response)
-        return response.decode('ascii')
-    else:
-        # print('<--', repr(partial), '+', response, exception)
-        return (partial + response.decode('ascii'), exception)
+    def recv_into(self, buffer, nbytes = 0, flags = 0):
+        buf = self.read_buffer
+        if not buf:
+            return super().recv_into(buffer, nbytes, flags)
+        view = memoryview(buffer).cast('B')
+        n = min(nbytes or len(view), len(buf))
+        view[:n] = buf[:n]
+        if not flags & pysocket.MSG_PEEK:
+            del buf[:n]
+        return n
+
+
+def sam_readline(sock, partial = None):
+    """read a line from a sam control socket"""
+    return sock.readline(partial)
 
 
 def make_reply_reader(sock):
@@ -104,23 +163,69 @@ def line_generator(sock):
 
 
 class SAMReply(object):
-    __slots__ = ('cmd', 'opts')
+    """A parsed SAM reply line.
+
+    The line is only searched for an option when it is read, and quoted
+    values are only unquoted then.
+    """
 
-    def __init__(self, cmd = None, opts = None):
+    __slots__ = ('cmd', 'line', 'tokens', '_opts')
+
+    def __init__(self, cmd = None, line = ''):
         self.cmd = cmd
-        self.opts = opts
+        # the rest of the line, after cmd
+        self.line = line
+        # (plain, quoted) dicts of all options, split on first need
+        self.tokens = None
+        self._opts = None
 
     def __getitem__(self, key):
-        return self.opts[key]
+        head, sep, tail = self.line.partition(' ' + key + '=')
+        if not sep:
+            raise KeyError(key)
+        if '"' in head:
+            # the match may be inside a quoted value
+            return self._tokenized(key)
+        if tail.startswith('"'):
+            return unquote(tail[0:closing_quote(tail, 1) + 1])
+        return tail.partition(' ')[0]
+
+    def _tokenized(self, key):
+        if self.tokens is None:
+            self.tokens = tokenize_quoted(self.line)
+        opts, quoted = self.tokens
+        if key in opts:
+            return opts[key]
+        return unquote(quoted[key])
 
     def get(self, key, default = None):
-        return self.opts.get(key, default)
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def _keys(self):
+        if self.tokens is None:
+            self.tokens = tokenize_quoted(self.line)
+        opts, quoted = self.tokens
+        return list(opts) + list(quoted)
+
+    @property
+    def opts(self):
+        """a dict of every option, quoted values unquoted, built on first use"""
+        if self._opts is None:
+            if self.tokens is None:
+                self.tokens = tokenize_quoted(self.line)
+            opts, quoted = self.tokens
+            self._opts = dict(opts)
+            self._opts.update((key, unquote(value)) for (key, value) in quoted.items())
+        return self._opts
 
     def __iter__(self):
-        return iter(self.opts)
+        return iter(self._keys())
 
     def __len__(self):
-        return len(self.opts)
+        return len(self._keys())
 
     @property
     def ok(self):
@@ -128,16 +233,67 @@ class SAMReply(object):
 
     @property
     def result(self):
-        return self.opts.get('RESULT')
+        return self.get('RESULT')
 
     @property
     def message(self):
-        return self.opts.get('MESSAGE')
+        return self.get('MESSAGE')
 
     def __repr__(self):
         return '<%s %r %r>' % (self.__class__.__name__, self.result, self.message)
 
 
+def tokenize_quoted(options):
+    """split options that have quoted values, which may hold spaces and escapes.
+
+    Returns a dict of plain values and a dict of values still in quotes.
+    """
+    opts = {}
+    quoted = {}
+    length = len(options)
+    pos = 0
+    while pos < length:
+        end = options.find(' ', pos)
+        if end < 0:
+            end = length
+        eq_index = options.find('=', pos, end)
+        if eq_index < 0:
+            pos = end + 1
+            continue
+        key = options[pos:eq_index]
+        if options.startswith('"', eq_index + 1):
+            end = closing_quote(options, eq_index + 2) + 1
+            quoted[key] = options[eq_index+1:end]
+        else:
+            opts[key] = options[eq_index+1:end]
+        pos = end + 1
+    return (opts, quoted)
+
+def closing_quote(options, start):
+    """return the index of the quote which ends a value starting at start"""
+    pos = start
+    while True:
+        index = options.find('"', pos)
+        if index < 0:
+            # unterminated, the value runs to the end of the line
+            return len(options) - 1
+        # a quote after an odd number of backslashes is escaped
+        b_index = index
+        while b_index > start and options[b_index-1] == '\\':
+            b_index -= 1
+        if (index - b_index) % 2 == 0:
+            return index
+        pos = index + 1
+
+escaped_char = re.compile(r'\\(.)', re.DOTALL)
+
+def unquote(value):
+    if len(value) > 1 and value.endswith('"'):
+        value = value[1:-1]
+    else:
+        value = value[1:]
+    return escaped_char.sub(r'\1', value)
+
 def split_kv(sub_parts):
     for part in sub_parts:
         if '=' in part:
@@ -149,13 +305,14 @@ def join_kv(options):
 
 
 def sam_parse_reply(line):
-    """parse a reply line into a dict"""
-    parts = line.split(' ')
-    opts = {k: v for (k, v) in split_kv(parts[2:])}
-    return SAMReply(parts[0], opts)
-
-def sam_send(sock, line_and_data):
-    """Send a line to the SAM controller, but don't read it"""
+    """parse a reply line, str or bytes, into a SAMReply"""
+    if not isinstance(line, str):
+        line = line.decode('utf-8', 'replace')
+    cmd, sep, rest = line.partition(' ')
+    return SAMReply(cmd, rest)
+
+def sam_pack(line_and_data):
+    """Encode a line, and optionally its data, for the SAM controller"""
     if isinstance(line_and_data, tuple):
         line, data = line_and_data
     else:
@@ -163,7 +320,11 @@ def sam_send(sock, line_and_data):
 
     line = bytes(line, encoding='ascii') + b' \n'
     # print('-->', line, data)
-    sock.sendall(line + data)
+    return line + data
+
+def sam_send(sock, line_and_data):
+    """Send a line to the SAM controller, but don't read it"""
+    sock.sendall(sam_pack(line_and_data))
 
 def sam_cmd(sock, line, parse=True):
     """Send a line to the SAM controller, returning the parsed response"""
@@ -174,6 +335,15 @@ def sam_cmd(sock, line, parse=True):
     else:
         return reply_line
 
+def sam_run(sock, parser):
+    """Drive a command generator over a blocking SAM socket, returning its result"""
+    request = next(parser)
+    sam_send(sock, request)
+    result = None
+    while result is None:
+        result = parser.send(sam_readline(sock))
+    return result
+
 
 ########## handshake ##########
 
@@ -198,29 +368,52 @@ class AcceptError(OSError):
         super().__init__(errno.EADDRNOTAVAIL, msg)
 
 def controller_connect(sam_api, timeout):
-    sam_sock = pysocket.create_connection(sam_api)
+    sock = pysocket.create_connection(sam_api)
+    sam_sock = SAMSocket(fileno=sock.detach())
     sam_sock.setsockopt(pysocket.IPPROTO_TCP, pysocket.SO_KEEPALIVE, 1)
     sam_sock.settimeout(timeout)
     return sam_sock
 
-def handshake(timeout, sam_api, max_version):
-    """handshake with sam via a socket.socket instance"""
-    sock = controller_connect(sam_api, timeout=timeout)
-    response = sam_cmd(sock, greet(max_version))
-    if response.ok:
-        return sock
+def hello(max_version):
+    line = yield greet(max_version)
+    reply = sam_parse_reply(line)
+    if reply.ok:
+        yield reply
     else:
-        raise HandshakeError("Failed to handshake with SAM: %s" % repr(response))
+        raise HandshakeError("Failed to handshake with SAM: %s" % repr(reply))
 
-@contextmanager
-def context_handshake(timeout, sam_api, max_version):
-    sock = None
+def handshake(timeout, sam_api, max_version, observers = no_observers):
+    """handshake with sam via a socket.socket instance"""
+    with observers.timed('connect'):
+        sock = controller_connect(sam_api, timeout=timeout)
+    try:
+        with observers.timed('handshake'):
+            reply = sam_run(sock, hello(max_version))
+    except BaseException:
+        sock.close()
+        raise
+    sock.version = reply.get('VERSION', '3.0')
+    return sock
+
+def handshake_many(count, timeout, sam_api, max_version, observers = no_observers):
+    """handshake over `count` new sockets, with all HELLOs in flight at once"""
+    socks = []
     try:
-        sock = handshake(timeout=timeout, sam_api=sam_api, max_version=max_version)
-        yield sock
-    finally:
-        if sock:
+        for i in range(count):
+            with observers.timed('connect'):
+                socks.append(controller_connect(sam_api, timeout=timeout))
+        parsers = [hello(max_version) for sock in socks]
+        with observers.timed('handshake'):
+            for (sock, parser) in zip(socks, parsers):
+                sam_send(sock, next(parser))
+            for (sock, parser) in zip(socks, parsers):
+                reply = parser.send(sam_readline(sock))
+                sock.version = reply.get('VERSION', '3.0')
+    except BaseException:
+        for sock in socks:
             sock.close()
+        raise
+    return socks
 
 
 ########## SAM socket commands ##########
@@ -230,42 +423,137 @@ def lookup_cache(domain, cache):
         return domain
     domain = normalize_domain(domain)
     dest = cache.get(domain)
-    if dest:
-        return dest
+    if isinstance(dest, NSError):
+        # negative cache hit
+        raise NSError(dest.strerror)
+    return dest
 
-def lookup(sock, domain, cache = None):
-    """lookup an I2P domain name, returning a Destination instance"""
+def naming_lookup(domain, cache = None):
     domain = normalize_domain(domain)
 
     # cache miss, perform lookup
-    reply = sam_cmd(sock, "NAMING LOOKUP NAME=%s" % domain)
+    line = yield "NAMING LOOKUP NAME=%s" % domain
+    reply = sam_parse_reply(line)
 
     b64_dest = reply.get('VALUE')
     if b64_dest:
         dest = Dest(b64_dest, encoding='base64')
-        if cache:
-            cache[dest.base32 + '.b32.i2p'] = dest
-        return dest
+        if hasattr(cache, 'add_error'):
+            cache.add(domain, dest)
+        elif cache is not None:
+            # a plain mapping, as accepted before NSCache
+            cache[domain] = cache[dest.base32 + '.b32.i2p'] = dest
+        yield dest
     else:
-        raise NSError('Domain name %r not resolved because %r' % (domain, reply))
+        error = NSError('Domain name %r not resolved because %r' % (domain, reply))
+        if hasattr(cache, 'add_error'):
+            # a plain mapping could not expire it
+            cache.add_error(domain, error)
+        raise error
+
+def lookup(sock, domain, cache = None):
+    """lookup an I2P domain name, returning a Destination instance.
+
+    `cache` is an NSCache, or a plain dict which is only given resolved names.
+    """
+    return sam_run(sock, naming_lookup(domain, cache))
+
+def lookup_pipelined(sock, domains, cache = None, window = 64):
+    """send NAMING LOOKUPs back to back, yielding (domain, Dest or NSError/ValueError) in order"""
+    domains = iter(domains)
+    pending = deque()
+    exhausted = False
+    while True:
+        if not exhausted and len(pending) <= window // 2:
+            batch = []
+            while len(pending) < window:
+                domain = next(domains, None)
+                if domain is None:
+                    exhausted = True
+                    break
+                parser = naming_lookup(domain, cache)
+                batch.append(sam_pack(next(parser)))
+                pending.append((domain, parser))
+            if batch:
+                sock.sendall(b''.join(batch))
+        if not pending:
+            return
+
+        # SAM answers the commands on one socket in order
+        domain, parser = pending.popleft()
+        line = sam_readline(sock)
+        try:
+            result = parser.send(line)
+        except (NSError, ValueError) as e:
+            # the whole reply was read, the socket is still in step
+            result = e
+        yield (domain, result)
 
 
-def session_create(sock, sock_type, sig_type, name, i2cp_options = None):
+def session_setup(sock_type, sig_type, name, i2cp_options = None, private_key = None):
     i2cp = i2cp_options or {}
     sock_type = sock_type.upper()
-    if sock_type not in ('STREAM', 'DATAGRAM'):
+    if sock_type not in ('STREAM', 'DATAGRAM', 'RAW', 'PRIMARY'):
         raise NotImplementedError('Socket type %s is not implemented' % repr(sock_type))
 
-    cmd = 'SESSION CREATE STYLE=%s DESTINATION=TRANSIENT SIGNATURE_TYPE=%d ID=%s ' % (sock_type, sig_type, name)
+    if private_key:
+        # the signature type is part of the key
+        cmd = 'SESSION CREATE STYLE=%s DESTINATION=%s ID=%s ' % (sock_type, Dest.b64encode(private_key), name)
+    else:
+        cmd = 'SESSION CREATE STYLE=%s DESTINATION=TRANSIENT SIGNATURE_TYPE=%d ID=%s ' % (sock_type, sig_type, name)
     cmd += join_kv(i2cp)
-    reply = sam_cmd(sock, cmd)
+    line = yield cmd
+    reply = sam_parse_reply(line)
 
     # parse reply
     if reply.ok:
-        return reply['DESTINATION']
+        yield reply['DESTINATION']
     else:
         raise CreateDestError('Failed to create destination. %s' % repr(reply))
 
+def session_create(sock, sock_type, sig_type, name, i2cp_options = None, private_key = None):
+    return sam_run(sock, session_setup(sock_type, sig_type, name, i2cp_options, private_key))
+
+def session_add(sock_type, name, options = None):
+    """add a subsession to a SAM 3.3 PRIMARY session"""
+    sock_type = sock_type.upper()
+    if sock_type not in ('STREAM', 'DATAGRAM', 'RAW'):
+        raise NotImplementedError('Socket type %s is not implemented' % repr(sock_type))
+
+    cmd = 'SESSION ADD STYLE=%s ID=%s ' % (sock_type, name)
+    cmd += join_kv(options or {})
+    line = yield cmd
+    reply = sam_parse_reply(line)
+    if reply.ok:
+        yield reply
+    else:
+        raise CreateDestError('Failed to add subsession %r. %r' % (name, reply))
+
+def session_remove(name):
+    line = yield 'SESSION REMOVE ID=%s' % name
+    reply = sam_parse_reply(line)
+    if reply.ok:
+        yield reply
+    else:
+        raise CreateDestError('Failed to remove subsession %r. %r' % (name, reply))
+
+
+def load_keyfile(path):
+    """read a raw private key file, returning None if it does not exist"""
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def save_keyfile(path, private_key):
+    """write a raw private key file that only its owner can read"""
+    tmp_path = path + '.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(private_key)
+    os.replace(tmp_path, path)
+
 def bind_datagram(binding):
     dgram_sock = pysocket.socket(type=pysocket.SOCK_DGRAM)
     dgram_sock.bind(binding)
@@ -292,6 +580,15 @@ def stream_accept(nickname):
     else:
         raise AcceptError('Failed to accept %r because %r' % (nickname, reply))
 
+def stream_forward(nickname, forward):
+    host, port = forward
+    line = yield ('STREAM FORWARD ID=%s PORT=%d HOST=%s SILENT=false' % (nickname, port, host))
+    reply = sam_parse_reply(line)
+    if reply.ok:
+        yield reply
+    else:
+        raise AcceptError('Failed to forward %r to %r because %r' % (nickname, forward, reply))
+
 def accept_dest_generator():
     line = yield None
     yield parse_reply_dest(line)
@@ -307,10 +604,12 @@ def parse_reply_dest(line):
 ########## datagram stuff ##########
 
 def datagram_send(data, dest):
-    header = 'DATAGRAM SEND DESTINATION=%s SIZE=%s' % (dest.base64, str(len(data)))
-    line = yield (header, data)
-    reply = sam_parse_reply(line)
-    yield Dest(reply['DESTINATION'], encoding='base64'), int(reply['SIZE'])
+    # SAM does not reply to DATAGRAM SEND
+    yield ('DATAGRAM SEND DESTINATION=%s SIZE=%d' % (dest.base64, len(data)), data)
+
+def raw_send(data, dest):
+    # neither signed nor repliable, SAM does not reply either
+    yield ('RAW SEND DESTINATION=%s SIZE=%d' % (dest.base64, len(data)), data)
 
 def pack_datagram(data, max_version, nickname, dest, options):
     header = ' '.join((max_version, nickname, dest.base64, join_kv(options))).rstrip() + '\n'
@@ -330,7 +629,8 @@ class Dest(object):
         EdDSA_SHA512_Ed25519: 32,
     }
 
-    __slots__ = ('secret_key', 'signing_secret_key', 'keys_cert', 'sig_type')
+    __slots__ = ('secret_key', 'signing_secret_key', 'keys_cert', 'sig_type',
+        '_base64', '_base32', '_digest')
 
     def __init__(self, keyfile, encoding, sig_type = None, private=False):
         if encoding not in ('base64', 'raw'):
@@ -342,31 +642,58 @@ class Dest(object):
 
         if encoding == 'base64':
             keyfile = self.__class__.b64decode(keyfile)
-        keyfile = BytesIO(keyfile)
+        keyfile = memoryview(keyfile)
 
-        self.keys_cert = self.__class__.read_keys_cert(keyfile)
+        self.keys_cert, offset = self.__class__.read_keys_cert(keyfile, 0)
         if private:
-            self.secret_key = self.__class__.read_secret_key(keyfile)
-            self.signing_secret_key = self.__class__.read_signing_secret_key(keyfile, sig_type)
+            self.secret_key, offset = self.__class__.read_secret_key(keyfile, offset)
+            self.signing_secret_key, offset = self.__class__.read_signing_secret_key(keyfile, offset, sig_type)
 
-        if keyfile.read(1):
+        if offset != len(keyfile):
             raise ValueError('Found extra bytes at the end of keyfile')
 
+        self._base64 = None
+        self._base32 = None
+        self._digest = None
+
     def __repr__(self):
         return '<%s %r>' % (self.__class__.__name__, self.base32)
 
+    def __eq__(self, other):
+        if not isinstance(other, Dest):
+            return NotImplemented
+        return self.keys_cert == other.keys_cert
+
+    def __hash__(self):
+        # bytes objects cache their own hash
+        return hash(self.keys_cert)
+
     @property
     def is_private(self):
         return hasattr(self, 'secret_key')
 
+    @property
+    def private_key(self):
+        """the raw keyfile, which SAM accepts in place of DESTINATION=TRANSIENT"""
+        return self.keys_cert + self.secret_key + self.signing_secret_key
+
     @property
     def base64(self):
-        return self.__class__.b64encode(self.keys_cert)
+        if self._base64 is None:
+            self._base64 = self.__class__.b64encode(self.keys_cert)
+        return self._base64
+
+    @property
+    def digest(self):
+        if self._digest is None:
+            self._digest = sha256(self.keys_cert).digest()
+        return self._digest
 
     @property
     def base32(self):
-        digest = sha256(self.keys_cert).digest()
-        return base64.b32encode(digest).rstrip(b'=').lower().decode('ascii')
+        if self._base32 is None:
+            self._base32 = base64.b32encode(self.digest).rstrip(b'=').lower().decode('ascii')
+        return self._base32
 
     @staticmethod
     def b64encode(arg):
@@ -377,33 +704,47 @@ class Dest(object):
         return base64.b64decode(arg + '=' * (-len(arg) % 4), '-~')
 
     @staticmethod
-    def _read(keyfile, read_len, throw='Keyfile truncated'):
-        data = keyfile.read(read_len)
+    def _read(keyfile, offset, read_len, throw='Keyfile truncated'):
+        data = keyfile[offset:offset+read_len]
         if len(data) != read_len:
             raise ValueError(throw + ' %d < %d' % (len(data), read_len))
-        return data
+        return (bytes(data), offset + read_len)
 
     @classmethod
-    def read_keys_cert(cls, keyfile):
+    def read_keys_cert(cls, keyfile, offset):
         fixed_len = 256 + 128 + 3
-        keys_cert_header = cls._read(keyfile, fixed_len, throw='KeysAndCert header truncated')
+        if len(keyfile) - offset < fixed_len:
+            raise ValueError('KeysAndCert header truncated %d < %d' % (len(keyfile) - offset, fixed_len))
 
-        body_len = struct.unpack('!H', keys_cert_header[-2:])[0]
-        body = cls._read(keyfile, body_len, throw='Certificate body truncated')
+        body_len = struct.unpack_from('!H', keyfile, offset + fixed_len - 2)[0]
+        if len(keyfile) - offset < fixed_len + body_len:
+            raise ValueError('Certificate body truncated %d < %d' % (len(keyfile) - offset - fixed_len, body_len))
 
-        return keys_cert_header + body
+        return cls._read(keyfile, offset, fixed_len + body_len)
+
+    @classmethod
+    def read_sig_type(cls, keyfile):
+        """the signature type in the certificate of a raw keyfile, if we can sign with it"""
+        keys_cert, offset = cls.read_keys_cert(memoryview(keyfile), 0)
+        cert_type = keys_cert[256 + 128]
+        if cert_type != 5:
+            # not a KEY certificate, hence the original DSA_SHA1
+            sig_type = 0
+        else:
+            sig_type = struct.unpack_from('!H', keys_cert, 256 + 128 + 3)[0]
+        if sig_type not in cls.sskey_len_dict:
+            raise NotImplementedError('Signing key type %s not implemented' % repr(sig_type))
+        return sig_type
 
     @classmethod
-    def read_secret_key(cls, keyfile):
+    def read_secret_key(cls, keyfile, offset):
         key_len = 256
-        secret_key = cls._read(keyfile, key_len, throw='Secret key truncated')
-        return secret_key
+        return cls._read(keyfile, offset, key_len, throw='Secret key truncated')
 
     @classmethod
-    def read_signing_secret_key(cls, keyfile, sig_type):
+    def read_signing_secret_key(cls, keyfile, offset, sig_type):
         key_len = cls.sskey_len_dict[sig_type]
-        secret_signing = cls._read(keyfile, key_len, throw='Secret signing key truncated')
-        return secret_signing
+        return cls._read(keyfile, offset, key_len, throw='Secret signing key truncated')
 
 
 
@@ -1,15 +1,32 @@
-from .samtools import make_reply_reader, sam_send, pack_datagram, parse_reply_dest
-from errno import EACCES
+from .samtools import (make_reply_reader, sam_send, sam_pack, pack_datagram,
+    datagram_send, raw_send, parse_reply_dest, SAMSocket)
+from .cache import InternTable, LRUCache
+from .protocol import split_frame
+from errno import EACCES, EINVAL
+from socket import socket, SHUT_WR, SHUT_RDWR, timeout as SocketTimeout
+from time import monotonic
+import os
+import selectors
+import threading
 
 class SourceError(OSError):
     def __init__(self, message):
         super().__init__(EACCES, message)
 
 
+class _Pending(object):
+    __slots__ = ()
+
+    def __repr__(self):
+        return 'PENDING'
+
+PENDING = _Pending()
+
+
 class WrappedSocket(object):
     """A python socket wrapped to expose I2P addresses instead of IP addresses"""
 
-    __slots__ = ('sock', 'controller', 'reply_generator')
+    __slots__ = ('sock', 'controller', 'reply_generator', 'phase', 'sent_at')
 
     __passthru = frozenset(('type', 'proto', 'send', 'recv', 'sendall', 'sendfile',
         'fileno', 'shutdown', 'detach', 'makefile', 'setsockopt',
@@ -19,10 +36,14 @@ class WrappedSocket(object):
         'gethostbyname', 'gethostbyname_ex'))
 
     def __init__(self, sock, controller, parser):
-        self.__class__._send_data(sock, parser)
+        request_line = self.__class__._send_data(sock, parser)
         sock.settimeout(None)
         self.sock = sock
         self.controller = controller
+        self.sent_at = None
+        if request_line is not None and controller.observers:
+            self.phase = 'stream_accept' if request_line.startswith('STREAM ACCEPT') else 'stream_connect'
+            self.sent_at = monotonic()
 
         reader = make_reply_reader(sock)
         self.reply_generator = self._make_loop(parser, reader)
@@ -32,6 +53,7 @@ class WrappedSocket(object):
         if generator:
             request_line = next(generator)
             sam_send(sock, request_line)
+            return request_line
         # print('End of sending SAM data')
 
     def __getattr__(self, name):
@@ -89,51 +111,392 @@ class WrappedSocket(object):
                 parser_result = parser.send(reply)
 
     def parse_headers(self):
-        loop_result = next(self.reply_generator)
+        try:
+            loop_result = next(self.reply_generator)
+        except BaseException:
+            self._observe_headers(True)
+            raise
         if isinstance(loop_result, BaseException):
+            self._observe_headers(True)
+            raise loop_result
+        else:
+            self._observe_headers(False)
+            return loop_result
+
+    def try_parse_headers(self):
+        """like parse_headers, but return PENDING if the reply is not complete yet"""
+        try:
+            loop_result = next(self.reply_generator)
+        except BaseException:
+            self._observe_headers(True)
+            raise
+        if isinstance(loop_result, (BlockingIOError, SocketTimeout)):
+            return PENDING
+        elif isinstance(loop_result, BaseException):
+            self._observe_headers(True)
             raise loop_result
         else:
+            self._observe_headers(False)
             return loop_result
 
+    def _observe_headers(self, failed):
+        if self.sent_at is None:
+            return
+        observers = self.controller.observers
+        observers.emit(self.phase, monotonic() - self.sent_at)
+        if failed:
+            observers.emit(self.phase + '_errors', 1)
+        self.sent_at = None
+
+
+class HeaderSelector(object):
+    """Wait on the SAM reply headers of many wrapped sockets at once.
+
+    Registered sockets are put in non-blocking mode. Once their headers
+    are parsed they are unregistered and made blocking again. A socket
+    that failed, or ran past its deadline, is closed.
+    """
+
+    __slots__ = ('selector',)
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+
+    def register(self, sock, timeout = None):
+        deadline = None if timeout is None else monotonic() + timeout
+        sock.setblocking(False)
+        self.selector.register(sock, selectors.EVENT_READ, deadline)
+
+    def __len__(self):
+        return len(self.selector.get_map())
+
+    def select(self, timeout = None):
+        """wait, then return a list of (sock, headers or exception) for finished sockets"""
+        keys = list(self.selector.get_map().values())
+        deadlines = [key.data for key in keys if key.data is not None]
+        if deadlines:
+            wait = max(0.0, min(deadlines) - monotonic())
+            timeout = wait if timeout is None else min(timeout, wait)
+
+        done = []
+        for (key, events) in self.selector.select(timeout):
+            sock = key.fileobj
+            try:
+                result = sock.try_parse_headers()
+            except (OSError, EOFError, ValueError) as e:
+                result = e
+            if result is not PENDING:
+                done.append((sock, result))
+
+        now = monotonic()
+        finished = frozenset(sock for (sock, result) in done)
+        for key in keys:
+            if key.data is not None and key.data <= now and key.fileobj not in finished:
+                done.append((key.fileobj, SocketTimeout('No SAM reply before the deadline')))
+
+        for (sock, result) in done:
+            self.selector.unregister(sock)
+            if isinstance(result, BaseException):
+                sock.close()
+            else:
+                sock.settimeout(None)
+        return done
+
+    def close(self):
+        """close the selector and every socket still waiting"""
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+
+
+def wait_headers(socks, timeout = None):
+    """yield (sock, headers or exception) as the SAM reply headers of socks arrive"""
+    selector = HeaderSelector()
+    try:
+        for sock in socks:
+            selector.register(sock, timeout)
+        while len(selector):
+            yield from selector.select()
+    finally:
+        selector.close()
+
+
+class StreamListener(object):
+    """Accept I2P streams which SAM forwards to a local TCP port.
+
+    The router opens one plain TCP connection per stream, starting with
+    a line that holds the Destination of the remote peer. The SAM
+    connection which asked for the forwarding has to stay open.
+    """
+
+    __slots__ = ('listener', 'sam_sock', 'controller')
+
+    def __init__(self, listener, sam_sock, controller):
+        self.listener = listener
+        self.sam_sock = sam_sock
+        self.controller = controller
+
+    def accept(self):
+        """return a (Dest, socket) pair, with the Destination line stripped"""
+        conn, address = self.listener.accept()
+        sock = SAMSocket(fileno=conn.detach())
+        try:
+            sock.settimeout(self.controller.sam_timeout)
+            addr = parse_reply_dest(sock.readline())
+            sock.settimeout(None)
+        except BaseException:
+            sock.close()
+            raise
+        # payload bytes read along with the line stay in the socket buffer
+        return (addr, sock)
+
+    def fileno(self):
+        return self.listener.fileno()
+
+    def getsockname(self):
+        return self.listener.getsockname()
+
+    def close(self):
+        self.listener.close()
+        self.sam_sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 dgram_header_len = 2048
+default_header_entries = 256
+# vectored sends skip the header + payload concatenation
+has_sendmsg = hasattr(socket, 'sendmsg')
+
+relay_bufsize = 64 * 1024
+# splice moves bytes socket -> pipe -> socket without copying them to userspace
+has_splice = hasattr(os, 'splice')
 
 class StreamSocket(WrappedSocket):
-    pass
+
+    def relay(self, other, bufsize=relay_bufsize):
+        """Pump bytes both ways between this stream and `other` until both directions end.
+
+        When one side stops sending, the other side's write half is shut
+        down, and the opposite direction keeps going. A slow reader slows
+        its writer down, since nothing is read before the last chunk is sent.
+        Returns (bytes from this stream to other, bytes from other to this stream).
+        """
+        other = other.sock if isinstance(other, WrappedSocket) else other
+        results = [0, 0]
+        errors = []
+
+        def pump(index, src, dst):
+            try:
+                results[index] = _pump(src, dst, bufsize)
+            except (OSError, EOFError) as e:
+                errors.append(e)
+                # wake up the other direction too
+                for sock in (src, dst):
+                    try:
+                        sock.shutdown(SHUT_RDWR)
+                    except OSError:
+                        pass
+
+        thread = threading.Thread(target=pump, args=(1, other, self.sock), daemon=True)
+        thread.start()
+        pump(0, self.sock, other)
+        thread.join()
+        if errors:
+            raise errors[0]
+        return tuple(results)
+
+
+def _pump(src, dst, bufsize):
+    """copy src to dst until EOF, then shut down the write half of dst"""
+    total = 0
+    read_buffer = getattr(src, 'read_buffer', None)
+    if read_buffer:
+        # bytes that arrived with the SAM reply go first
+        total += len(read_buffer)
+        dst.sendall(read_buffer)
+        read_buffer.clear()
+
+    if has_splice and src.gettimeout() is None and dst.gettimeout() is None:
+        total += _splice_pump(src, dst, bufsize)
+    else:
+        total += _copy_pump(src, dst, bufsize)
+    try:
+        dst.shutdown(SHUT_WR)
+    except OSError:
+        pass
+    return total
+
+def _splice_pump(src, dst, bufsize):
+    read_fd, write_fd = os.pipe()
+    src_fd, dst_fd = src.fileno(), dst.fileno()
+    total = 0
+    try:
+        while True:
+            try:
+                nbytes = os.splice(src_fd, write_fd, bufsize, flags=os.SPLICE_F_MOVE)
+            except OSError as e:
+                if e.errno == EINVAL and not total:
+                    # not a file the kernel can splice from
+                    return _copy_pump(src, dst, bufsize)
+                raise
+            if not nbytes:
+                return total
+            while nbytes:
+                sent = os.splice(read_fd, dst_fd, nbytes, flags=os.SPLICE_F_MOVE)
+                nbytes -= sent
+                total += sent
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+def _copy_pump(src, dst, bufsize):
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    total = 0
+    while True:
+        nbytes = src.recv_into(buf)
+        if not nbytes:
+            return total
+        dst.sendall(view[0:nbytes])
+        total += nbytes
 
 class DatagramSocket(WrappedSocket):
-    __slots__ = ('name', 'forward_mode')
+    """Datagrams through the SAM UDP port, or, if not in forward mode,
+    framed as DATAGRAM SEND / DATAGRAM RECEIVED on the session's SAM socket"""
+
+    __slots__ = ('name', 'forward_mode', 'sources', 'headers', 'recv_buffer', 'observers')
     __blocked = frozenset(('recv', 'send', 'sendall', 'sendfile', 'sendto', 'recvfrom'))
 
-    def __init__(self, sock, controller, name, parser):
+    received_verb = b'DATAGRAM RECEIVED'
+    send_generator = staticmethod(datagram_send)
+
+    def __init__(self, sock, controller, name, forward_mode=True):
         self.name = name
-        self.forward_mode = False if parser else True
-        super().__init__(sock, controller, parser)
+        self.forward_mode = forward_mode
+        self.sources = InternTable()
+        self.headers = LRUCache(default_header_entries)
+        self.recv_buffer = None
+        self.observers = controller.observers
+        super().__init__(sock, controller, None)
 
     def __getattr__(self, name):
         if name in self.__blocked:
             raise AttributeError('%r object has no attribute %r' % (self.__class__.__name__, name))
         return super().__getattr__(name)
 
+    def close(self):
+        if self.forward_mode:
+            super().close()
+        else:
+            # the SAM socket belongs to the session, OurDest.close closes it
+            self._close_me()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     @property
     def dgram_api(self):
         return self.controller.dgram_api
 
     def transmit(self, *args):
         data = args[0]
-        dest = self.lookup(args[-1])
-        real_data = pack_datagram(data, self.controller.max_version, self.name, dest, {})
-        real_args = (real_data,) + args[1:-1] + (self.dgram_api,)
-        return self.sock.sendto(*real_args)
+        if not self.forward_mode:
+            dest = self.lookup(args[-1])
+            self.sock.sendall(sam_pack(next(self.send_generator(data, dest))))
+            nbytes = len(data)
+        else:
+            flags = args[1] if len(args) > 2 else 0
+            nbytes = self._send_packet(self._header(args[-1]), data, flags)
+        if self.observers:
+            self.observers.emit('dgram_sent', len(data))
+        return nbytes
+
+    def transmit_many(self, packets, flags=0):
+        """send (data, dest) pairs, building the header once per destination"""
+        if self.observers:
+            packets = self._observe_sent(packets)
+        if not self.forward_mode:
+            return self._stream_transmit_many(packets)
+
+        count = 0
+        dests = {}
+        for (data, dest) in packets:
+            real_dest = dests.get(dest)
+            if real_dest is None:
+                real_dest = dests[dest] = self.lookup(dest)
+            self._send_packet(self._header(real_dest), data, flags)
+            count += 1
+        return count
+
+    def _observe_sent(self, packets):
+        for packet in packets:
+            self.observers.emit('dgram_sent', len(packet[0]))
+            yield packet
+
+    def _send_packet(self, header, data, flags):
+        if has_sendmsg:
+            return self.sock.sendmsg((header, data), (), flags, self.dgram_api)
+        return self.sock.sendto(header + data, flags, self.dgram_api)
+
+    def _stream_transmit_many(self, packets):
+        # one write for the whole batch
+        dests = {}
+        frames = []
+        for (data, dest) in packets:
+            real_dest = dests.get(dest)
+            if real_dest is None:
+                real_dest = dests[dest] = self.lookup(dest)
+            frames.append(sam_pack(next(self.send_generator(data, real_dest))))
+        self.sock.sendall(b''.join(frames))
+        return len(frames)
+
+    def _header(self, dest):
+        """return the encoded SAM header for dest, a name or a Dest, cached per Destination"""
+        # a name goes through the NS cache every time, so it expires with it
+        dest = self.lookup(dest)
+        header = self.headers.get(dest)
+        if header is None:
+            header = pack_datagram(b'', self.controller.max_version, self.name, dest, {})
+            self.headers[dest] = header
+        return header
 
     def collect(self, bufsize=32*1024, *args):
         if self.forward_mode:
-            return self._datagram_collect(bufsize, *args)
+            packet = self._datagram_collect(bufsize, *args)
         else:
-            return self._stream_collect(bufsize, *args)
+            packet = self._stream_collect(bufsize, *args)
+        if self.observers:
+            self.observers.emit('dgram_received', len(packet[0]))
+        return packet
 
     def _stream_collect(self, bufsize, *args):
-        raise NotImplementedError()
+        reply, data = self._read_frame()
+        return (data[0:bufsize], self.sources.intern(reply['DESTINATION']))
+
+    def _read_frame(self):
+        """return the (header, payload) of the next DATAGRAM or RAW RECEIVED frame.
+
+        Nothing is consumed until the whole frame is buffered, so a
+        non-blocking socket can raise BlockingIOError and try again later.
+        """
+        sock = self.sock
+        while True:
+            line, data = split_frame(sock.read_buffer, self.received_verb)
+            if line is None:
+                if not sock._fill_buffer(data):
+                    raise EOFError('SAM connection died. Partial response %r' % bytes(sock.read_buffer))
+            elif data is not None:
+                return (line, data)
+            elif line.startswith(b'PING'):
+                # not a datagram, answer keepalives and skip the rest
+                sam_send(sock, 'PONG' + line[4:].decode('ascii'))
 
     def _datagram_collect(self, bufsize, *args):
         real_bufsize = bufsize + dgram_header_len
@@ -141,12 +504,111 @@ class DatagramSocket(WrappedSocket):
         if address != self.dgram_api:
             raise SourceError('Packet src=%r not from SAM UDP API %r' % (address, self.dgram_api))
 
-        # parse SAM reply header
-        lf_index = data.index(b'\n')
-        line, real_data = data[0:lf_index].decode('ascii'), data[1+lf_index:]
-        real_address = parse_reply_dest(line)
+        offset, real_address = self._parse_header(data, len(data))
+        return (data[offset:], real_address)
+
+    def collect_into(self, buffer, *args):
+        """receive a datagram into buffer, returning (payload offset, payload length, source)"""
+        if not self.forward_mode:
+            data, real_address = self._stream_collect(len(buffer))
+            memoryview(buffer).cast('B')[0:len(data)] = data
+            offset, length = 0, len(data)
+        else:
+            nbytes, address = self.sock.recvfrom_into(buffer, 0, *args)
+            if address != self.dgram_api:
+                raise SourceError('Packet src=%r not from SAM UDP API %r' % (address, self.dgram_api))
+            offset, real_address = self._parse_header(buffer, nbytes)
+            length = nbytes - offset
+
+        if self.observers:
+            self.observers.emit('dgram_received', length)
+        return (offset, length, real_address)
+
+    def _parse_header(self, data, nbytes):
+        """return the payload offset and the source of a datagram in data[:nbytes]"""
+        if not hasattr(data, 'find'):
+            # a memoryview, search a copy of the header area only
+            data = bytes(data[0:min(nbytes, dgram_header_len)])
+            nbytes = len(data)
+        # parse SAM reply header, the source Destination comes first
+        lf_index = data.find(b'\n', 0, nbytes)
+        if lf_index < 0:
+            raise ValueError('SAM datagram header is not terminated')
+        space_index = data.find(b' ', 0, lf_index)
+        token = bytes(data[0:lf_index if space_index < 0 else space_index])
+        return (1 + lf_index, self.sources.intern(token))
+
+    def _receive_buffer(self, bufsize):
+        real_bufsize = bufsize + dgram_header_len
+        if self.recv_buffer is None or len(self.recv_buffer) < real_bufsize:
+            self.recv_buffer = bytearray(real_bufsize)
+        return self.recv_buffer
+
+    def collect_many(self, max_count=64, bufsize=32*1024):
+        """receive up to max_count datagrams, blocking only for the first one"""
+        if self.forward_mode:
+            receive = self._receive_many_datagrams(bufsize)
+        else:
+            receive = self._receive_many_frames(bufsize)
+
+        packets = []
+        timeout = self.sock.gettimeout()
+        try:
+            while len(packets) < max_count:
+                try:
+                    packet = next(receive)
+                except (BlockingIOError, SocketTimeout):
+                    if packets:
+                        break
+                    raise
+                if packet is None:
+                    continue
+                packets.append(packet)
+                if len(packets) == 1:
+                    # drain whatever else is queued without waiting
+                    self.sock.setblocking(False)
+        finally:
+            self.sock.settimeout(timeout)
+        if self.observers:
+            for (data, source) in packets:
+                self.observers.emit('dgram_received', len(data))
+        return packets
+
+    def _receive_many_datagrams(self, bufsize):
+        buf = self._receive_buffer(bufsize)
+        view = memoryview(buf)
+        while True:
+            nbytes, address = self.sock.recvfrom_into(buf)
+            if address != self.dgram_api:
+                # not forwarded by SAM, drop it
+                yield None
+                continue
+            offset, source = self._parse_header(buf, nbytes)
+            yield (bytes(view[offset:nbytes]), source)
+
+    def _receive_many_frames(self, bufsize):
+        while True:
+            yield self._stream_collect(bufsize)
+
+
+class RawSocket(DatagramSocket):
+    """Anonymous datagrams, which carry neither a source nor a signature.
+
+    Everything received comes with None in place of the source.
+    """
+
+    __slots__ = ()
+
+    received_verb = b'RAW RECEIVED'
+    send_generator = staticmethod(raw_send)
+
+    def _stream_collect(self, bufsize, *args):
+        reply, data = self._read_frame()
+        return (data[0:bufsize], None)
 
-        return (real_data, real_address)
+    def _parse_header(self, data, nbytes):
+        # SAM forwards bare payloads unless the session asked for HEADER=true
+        return (0, None)
 
 
-__all__ = ('SourceError',)
+__all__ = ('SourceError', 'StreamListener', 'PENDING', 'HeaderSelector', 'wait_headers')
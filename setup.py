@@ -24,7 +24,7 @@ setup(
     ],
     keywords='I2P SAM socket',
 
-    packages=['leaflet', 'leaflet.examples'],
-    python_requires='>=3'
+    packages=['leaflet', 'leaflet.examples', 'leaflet.bench', 'leaflet.aio'],
+    python_requires='>=3.7'
 )
 
@@ -0,0 +1,33 @@
+from time import time
+
+from leaflet import AddressBook, NSCache
+from leaflet.bench.fakesam import random_keys_cert
+from leaflet.samtools import Dest
+
+
+def new_dest():
+    return Dest(random_keys_cert(), encoding='raw')
+
+def test_later_record_overrides(tmp_path):
+    path = str(tmp_path / 'book')
+    old, new = new_dest(), new_dest()
+    with AddressBook(path) as book:
+        book.add('example.i2p', old)
+        book.add('example.i2p', new)
+        assert book.get('example.i2p') == new
+    with AddressBook(path) as book:
+        dest, stored_at = book.entry('example.i2p')
+        assert dest == new
+        assert abs(stored_at - time()) < 5
+        # both Destinations stay reachable by hash
+        assert book.get(old.base32 + '.b32.i2p') == old
+        assert book.entry(new.base32 + '.b32.i2p') == (new, None)
+
+def test_cache_expires_store_hits(tmp_path):
+    dest = new_dest()
+    with AddressBook(str(tmp_path / 'book')) as book:
+        book.add('example.i2p', dest)
+        assert NSCache(store=book).get('example.i2p') == dest
+        cache = NSCache(ttl=-1.0, store=book)
+        assert cache.get('example.i2p') is None
+        assert cache.misses == 1
@@ -0,0 +1,136 @@
+import pytest
+
+from leaflet.bench.fakesam import random_keys_cert
+from leaflet.protocol import (SAMConnection, ProtocolError, split_frame, CommandComplete,
+    CommandFailed, DatagramReceived, Ping, StreamData, ConnectionClosed, CONTROL, STREAM, CLOSED)
+from leaflet.samtools import (Dest, NSError, hello, naming_lookup, stream_accept,
+    datagram_send)
+
+
+@pytest.fixture
+def dest():
+    return Dest(random_keys_cert(), encoding='raw')
+
+def connected():
+    conn = SAMConnection()
+    conn.send(hello('3.3'))
+    assert conn.receive_data(b'HELLO REPLY RESULT=OK VERSION=3.3\n')[0].result.ok
+    return conn
+
+def feed_bytewise(conn, data):
+    events = []
+    for i in range(len(data)):
+        events += conn.receive_data(data[i:i+1])
+    return events
+
+
+def test_hello_first():
+    conn = SAMConnection()
+    with pytest.raises(ProtocolError):
+        conn.send(naming_lookup('example.i2p'))
+    assert conn.send(hello('3.3')).startswith(b'HELLO VERSION ')
+    events = conn.receive_data(b'HELLO REPLY RESULT=OK VERSION=3.1\n')
+    assert isinstance(events[0], CommandComplete)
+    assert conn.version == '3.1'
+    assert conn.state is CONTROL
+
+def test_reply_split_across_chunks(dest):
+    conn = connected()
+    conn.send(naming_lookup('example.i2p'))
+    line = b'NAMING REPLY RESULT=OK NAME=example.i2p VALUE=%s\n' % dest.base64.encode('ascii')
+    events = feed_bytewise(conn, line)
+    assert len(events) == 1
+    assert events[0].result == dest
+
+def test_pipelined_replies_and_errors(dest):
+    conn = connected()
+    conn.send(naming_lookup('a.i2p'))
+    conn.send(naming_lookup('bad.i2p'))
+    conn.send(naming_lookup('c.i2p'))
+    b64 = dest.base64.encode('ascii')
+    events = conn.receive_data(
+        b'NAMING REPLY RESULT=OK NAME=a.i2p VALUE=' + b64 + b'\n'
+        b'NAMING REPLY RESULT=KEY_NOT_FOUND NAME=bad.i2p\n'
+        b'NAMING REPLY RESULT=OK NAME=c.i2p VALUE=' + b64 + b'\n')
+    assert [type(e) for e in events] == [CommandComplete, CommandFailed, CommandComplete]
+    assert events[0].request == 'NAMING LOOKUP NAME=a.i2p'
+    assert isinstance(events[1].error, NSError)
+    assert events[2].result == dest
+    assert not conn.pending
+
+def test_accept_turns_into_stream(dest):
+    conn = connected()
+    conn.send(stream_accept('leaflet'))
+    events = conn.receive_data(b'STREAM STATUS RESULT=OK\n')
+    # the peer Destination comes on a second line
+    assert events == []
+    assert conn.state is CONTROL
+    events = conn.receive_data(dest.base64.encode('ascii') + b' FROM_PORT=0 TO_PORT=0\nGET / HTTP/1.0\r\n')
+    assert [type(e) for e in events] == [CommandComplete, StreamData]
+    assert events[0].result == dest
+    assert events[1].data == b'GET / HTTP/1.0\r\n'
+    assert conn.state is STREAM
+    assert conn.receive_data(b'more')[0].data == b'more'
+    assert conn.send(b'reply') == b'reply'
+    with pytest.raises(ProtocolError):
+        conn.send(naming_lookup('example.i2p'))
+
+def test_partial_datagram(dest):
+    conn = connected()
+    frame = b'DATAGRAM RECEIVED DESTINATION=%s SIZE=5 FROM_PORT=0 TO_PORT=0\nhello' % dest.base64.encode('ascii')
+    assert conn.receive_data(frame[:-3]) == []
+    events = conn.receive_data(frame[-3:] + b'RAW RECEIVED SIZE=3\nraw')
+    assert [type(e) for e in events] == [DatagramReceived, DatagramReceived]
+    assert events[0].data == b'hello'
+    assert events[0].source == dest
+    assert events[1].data == b'raw'
+    assert events[1].source is None
+
+def test_ping():
+    conn = connected()
+    events = conn.receive_data(b'PING 1234\n')
+    assert isinstance(events[0], Ping)
+    assert conn.pong(events[0]) == b'PONG 1234 \n'
+
+def test_no_reply_commands(dest):
+    conn = connected()
+    conn.send(datagram_send(b'data', dest))
+    assert not conn.pending
+    with pytest.raises(ProtocolError):
+        conn.receive_data(b'STREAM STATUS RESULT=OK\n')
+
+def test_eof_fails_pending_commands():
+    conn = connected()
+    conn.send(naming_lookup('a.i2p'))
+    conn.send(naming_lookup('b.i2p'))
+    events = conn.receive_data(b'NAMING REPLY RESU')
+    assert events == []
+    events = conn.receive_data(b'')
+    assert [type(e) for e in events] == [CommandFailed, CommandFailed, ConnectionClosed]
+    assert all(isinstance(e.error, EOFError) for e in events[:2])
+    assert conn.state is CLOSED
+    with pytest.raises(ProtocolError):
+        conn.receive_data(b'x')
+
+def test_line_too_long():
+    conn = connected()
+    with pytest.raises(ProtocolError):
+        conn.receive_data(b'x' * (64 * 1024 + 1))
+
+
+def test_split_frame():
+    buf = bytearray(b'PING\nRAW RECEIVED SIZE=4\nab')
+    assert split_frame(buf) == (b'PING', None)
+    assert split_frame(buf) == (None, 2)
+    buf += b'cd'
+    reply, data = split_frame(buf)
+    assert reply['SIZE'] == '4'
+    assert data == b'abcd'
+    assert buf == b''
+    assert split_frame(buf) == (None, None)
+
+def test_split_frame_other_verbs():
+    # a raw socket does not treat DATAGRAM RECEIVED as its own frames
+    buf = bytearray(b'DATAGRAM RECEIVED SIZE=1\nx')
+    assert split_frame(buf, b'RAW RECEIVED') == (b'DATAGRAM RECEIVED SIZE=1', None)
+    assert buf == b'x'
@@ -0,0 +1,67 @@
+from leaflet.samtools import sam_parse_reply, split_kv
+
+
+def test_plain_options():
+    reply = sam_parse_reply('HELLO REPLY RESULT=OK VERSION=3.1')
+    assert reply.cmd == 'HELLO'
+    assert reply.ok
+    assert reply['VERSION'] == '3.1'
+    assert reply.get('MESSAGE') is None
+    assert sorted(reply) == ['RESULT', 'VERSION']
+
+def test_bytes_line():
+    reply = sam_parse_reply(b'RAW RECEIVED SIZE=12 FROM_PORT=0 TO_PORT=0 PROTOCOL=18')
+    assert reply.cmd == 'RAW'
+    assert reply['SIZE'] == '12'
+    assert reply['PROTOCOL'] == '18'
+
+def test_missing_key():
+    reply = sam_parse_reply('STREAM STATUS RESULT=OK')
+    try:
+        reply['MESSAGE']
+    except KeyError:
+        pass
+    else:
+        assert False, 'no KeyError'
+    # a key is only matched as a whole option name
+    assert reply.get('SULT') is None
+
+def test_quoted_with_spaces():
+    reply = sam_parse_reply('STREAM STATUS RESULT=CANT_REACH_PEER MESSAGE="peer is offline" X=1')
+    assert reply.result == 'CANT_REACH_PEER'
+    assert reply.message == 'peer is offline'
+    assert reply['X'] == '1'
+    assert sorted(reply) == ['MESSAGE', 'RESULT', 'X']
+
+def test_escaped_quotes():
+    reply = sam_parse_reply(r'STREAM STATUS RESULT=I2P_ERROR MESSAGE="say \"hi\" now" X=1')
+    assert reply.message == 'say "hi" now'
+    assert reply['X'] == '1'
+
+def test_escaped_backslash_ends_value():
+    reply = sam_parse_reply(r'STREAM STATUS MESSAGE="C:\\" RESULT=OK')
+    assert reply.message == 'C:\\'
+    assert reply.result == 'OK'
+
+def test_unterminated_quote():
+    reply = sam_parse_reply('STREAM STATUS RESULT=I2P_ERROR MESSAGE="runs to the end')
+    assert reply.result == 'I2P_ERROR'
+    assert reply.message == 'runs to the end'
+
+def test_empty_quotes():
+    reply = sam_parse_reply('STREAM STATUS MESSAGE="" RESULT=OK')
+    assert reply.message == ''
+    assert reply.ok
+
+def test_key_inside_quoted_value():
+    reply = sam_parse_reply('STREAM STATUS MESSAGE="was RESULT=BAD before" RESULT=OK')
+    assert reply.result == 'OK'
+    assert reply.message == 'was RESULT=BAD before'
+
+def test_opts():
+    reply = sam_parse_reply(r'STREAM STATUS RESULT=I2P_ERROR MESSAGE="say \"hi\"" X=1')
+    assert reply.opts == {'RESULT': 'I2P_ERROR', 'MESSAGE': 'say "hi"', 'X': '1'}
+    assert reply.opts is reply.opts
+
+def test_split_kv():
+    assert dict(split_kv(['RESULT=OK', 'junk', 'VALUE=a=b'])) == {'RESULT': 'OK', 'VALUE': 'a=b'}